@@ -0,0 +1,81 @@
+"""
+clean_html.py
+
+Benchmarks tools.clean_html against the regex implementation it replaced, on the show notes
+of real feeds: every feed in the feed cache of bot.db, plus any feed URLs given as arguments.
+
+Run from the repository root:
+    python -m benchmarks.clean_html [feed_url ...]
+"""
+
+import re
+import sys
+import time
+import zlib
+
+import feedparser
+
+# Local modules
+from modules import tools, http_client
+from modules.database import db
+
+REPEATS = 5
+
+
+def regex_clean_html(text):
+    """
+    The five-pass implementation of tools.clean_html that html_sanitizer replaced.
+    """
+    text_clean = re.sub(r'</?(p|ul|br)>|</li>', '', text)
+    text_clean = re.sub(r'<(h1|h2|h3)[^>]*>', '<b>', text_clean)
+    text_clean = re.sub(r'</(h1|h2|h3)>', '</b>', text_clean)
+    text_clean = re.sub(r'<li>', '- ', text_clean)
+    text_clean = re.sub(r'&nbsp;', ' ', text_clean)
+
+    return text_clean
+
+
+def load_corpus(feed_urls):
+    """
+    Returns the raw subtitles and summaries of all episodes of the cached and given feeds,
+    and the time feedparser took to parse the feeds, for comparison.
+    """
+    bodies = [zlib.decompress(row[0]) for row in db.cursor.execute("SELECT body FROM feeds")]
+    for feed_url in feed_urls:
+        bodies.append(http_client.get(feed_url).content)
+
+    texts = []
+    started = time.perf_counter()
+    for body in bodies:
+        for entry in feedparser.parse(body)['entries']:
+            texts.extend(entry[key] for key in ("subtitle", "summary") if entry.get(key))
+    return texts, time.perf_counter() - started
+
+
+def best_time(func, texts):
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        for text in texts:
+            func(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(feed_urls):
+    texts, parse_time = load_corpus(feed_urls)
+    if not texts:
+        print("No show notes found. Open some podcasts in the bot first, or pass feed URLs as arguments.")
+        return
+
+    n_bytes = sum(len(text.encode()) for text in texts)
+    print(f"Corpus: {len(texts)} texts, {n_bytes / 1024:.0f} KiB, parsed by feedparser in {parse_time * 1000:.1f} ms.")
+    for name, func in (("regex", regex_clean_html), ("html_sanitizer", tools.clean_html)):
+        elapsed = best_time(func, texts)
+        print(f"{name:>15}: {elapsed * 1000:8.1f} ms, {n_bytes / elapsed / 1024 / 1024:6.1f} MiB/s, "
+              f"{elapsed / len(texts) * 1e6:6.1f} us per text")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
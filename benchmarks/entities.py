@@ -0,0 +1,90 @@
+"""
+entities.py
+
+Benchmarks building Episode objects from fetched rows with Episode.from_row, against the
+conversion it replaced, which built a dict per row and set attributes on an unslotted object.
+Measures the time to convert the rows and the memory the objects take up, on the episodes
+stored in bot.db, or on generated rows if there are fewer than N_ROWS.
+
+Run from the repository root:
+    python -m benchmarks.entities
+"""
+
+import time
+import tracemalloc
+
+# Local modules
+from modules.database import db, EP_COLUMNS
+from modules.entities import Episode
+
+N_ROWS = 50000
+REPEATS = 5
+
+
+class DictEpisode:
+    """
+    Episode as it was built before it had slots: from a dict of its columns, without slots.
+    """
+    def __init__(self, ep_info):
+        for attr in EP_COLUMNS:
+            setattr(self, attr, ep_info[attr])
+
+
+def dict_convert(row):
+    """
+    The conversion that Episode.from_row replaced in tools.convert_db_output_to_object.
+    """
+    ep_info = dict()
+    for i, key in enumerate(EP_COLUMNS):
+        ep_info[key] = row[i]
+    return DictEpisode(ep_info)
+
+
+def load_rows():
+    """
+    Returns N_ROWS episode rows, repeating the stored ones, or generated ones if there are none.
+    """
+    rows = db.cursor.execute(f"SELECT {', '.join(EP_COLUMNS)} FROM episodes LIMIT {N_ROWS}").fetchall()
+    if not rows:
+        rows = [(f"1{index}", "1", f"Episode {index}", "Subtitle", "Summary " * 20, "01 January 2020", "1h",
+                 f"https://example.com/{index}.mp3", None, "", 0, f"guid-{index}", 1577836800 + index, "Caption")
+                for index in range(N_ROWS)]
+    return (rows * (N_ROWS // len(rows) + 1))[:N_ROWS]
+
+
+def best_time(convert, rows):
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        for row in rows:
+            convert(row)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def object_memory(convert, rows):
+    """
+    Returns the bytes allocated for the objects built from rows, without the rows themselves.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [convert(row) for row in rows]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main():
+    rows = load_rows()
+    print(f"Corpus: {len(rows)} episode rows.")
+    for name, convert in (("dict", dict_convert), ("from_row", Episode.from_row)):
+        elapsed = best_time(convert, rows)
+        size = object_memory(convert, rows)
+        print(f"{name:>9}: {elapsed * 1000:8.1f} ms, {elapsed / len(rows) * 1e6:5.2f} us per row, "
+              f"{size / 1024 / 1024:5.1f} MiB, {size / len(rows):5.0f} bytes per object")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,37 +20,51 @@ $MadelineProto = new \danog\MadelineProto\API('session.madeline', $settings);
 $MadelineProto->start();
 
 
+// Jobs arrive over a Unix socket from modules/upload_jobs.py, one JSON line per connection.
+// The job is acknowledged once the upload starts, and the file ID or an error is written back
+// on the same connection, which wakes up the waiting bot thread immediately.
+$socket_path = __DIR__ . "/uploader.sock";
+if (file_exists($socket_path)) {
+    unlink($socket_path);
+}
+$server = stream_socket_server("unix://" . $socket_path, $errno, $errstr);
+if (!$server) {
+    die("Could not open $socket_path: $errstr ($errno)\n");
+}
+
+
+function reply($conn, $reply) {
+    fwrite($conn, json_encode($reply) . "\n");
+}
+
+
 while (TRUE) {
-    $path = "episodes_to_send/*.mp3";
-    $episodes_to_send = glob($path);
-    foreach ($episodes_to_send as $episode) {
-        // the '- 4' below is to remove the '.mp3' extension from the end of the path (sloppy)
-        $episode_data = substr($episode, 0, strlen($episode) - 4) . "_data.txt";
-        $episode_file_id_path = substr($episode, 0, strlen($episode) - 4) . ".txt";
-
-        $data_file = fopen($episode_data, 'r');
-        $data = fgets($data_file);
-        fclose($data_file);
-        $data = explode("::", $data);
-        $title = $data[0];
-        $artist = $data[1];
-        $thumb_id = $data[2];
+    $conn = @stream_socket_accept($server, -1);
+    if (!$conn) {
+        continue;
+    }
+
+    $job = json_decode(fgets($conn), true);
+    if (!is_array($job) || !isset($job['job_id'], $job['path'])) {
+        fclose($conn);
+        continue;
+    }
+    $job_id = $job['job_id'];
+    reply($conn, ['job_id' => $job_id, 'status' => 'uploading']);
 
+    try {
         $sentMessageAudio = $MadelineProto->messages->uploadMedia( ['peer' => 'me',
                                                                    'media' => ['_' => 'inputMediaUploadedDocument', 
-                                                                               'file' => $episode,
+                                                                               'file' => $job['path'],
                                                                                'attributes' => [['_' => 'documentAttributeAudio', 
                                                                                                  'voice' => false,
-                                                                                                 'title' => $title,
-                                                                                                 'performer' => $artist]
+                                                                                                 'title' => $job['title'],
+                                                                                                 'performer' => $job['performer']]
                                                                                                 ]
                                                                                 ],
-                                                                    'thumb' => $thumb_id
+                                                                    'thumb' => $job['thumb_id']
                                                                     ] );
 
-        unlink($episode);
-        unlink($episode_data);
-
         $botAPI_file = $MadelineProto->MTProtoToBotAPI($sentMessageAudio);
 
         foreach (['audio', 'document', 'photo', 'sticker', 'video', 'voice', 'video_note'] as $type) {
@@ -58,12 +72,11 @@ while (TRUE) {
                 $method = $type;
             }
         }
-        
-        $episode_file_id = $botAPI_file[$method]['file_id'];
 
-        $fp = fopen($episode_file_id_path, "wb");
-        fwrite($fp, $episode_file_id);
-        fclose($fp);
+        reply($conn, ['job_id' => $job_id, 'status' => 'done', 'file_id' => $botAPI_file[$method]['file_id']]);
+    } catch (\Throwable $e) {
+        reply($conn, ['job_id' => $job_id, 'status' => 'failed', 'error' => $e->getMessage()]);
     }
-    sleep(1);
-}
\ No newline at end of file
+
+    fclose($conn);
+}
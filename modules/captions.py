@@ -0,0 +1,61 @@
+"""
+captions.py
+
+Rendering of the captions shown in the episode view.
+
+Only imports html_sanitizer, which has no local imports of its own, so the database migrations
+can render captions while the rest of the modules are still being imported.
+"""
+
+import html
+
+# Local modules
+from . import html_sanitizer
+
+MAX_CAPTION_LENGTH = 1000
+
+
+def render_episode_caption(title, duration, published_str, subtitle, summary):
+    """
+    Returns a tuple of the caption, whether the description is too long for it, and the
+    show notes to send as a separate message when it is ('' otherwise).
+    """
+    description = summary if len(subtitle) == 0 else subtitle
+
+    too_long = False
+    shownotes = ''
+    if 0 < len(subtitle) < len(summary):
+        too_long = True
+        shownotes = summary
+
+    description_truncated = truncate(description)
+
+    if len(description_truncated) < len(description):
+        too_long = True
+        shownotes = description
+
+    caption = f"<b>{html.escape(title)}</b>\n{duration}, {published_str}\n\n{description_truncated}\n\n"
+    return caption, too_long, shownotes
+
+
+def truncate(s):
+    """
+    This is called when preparing an episode for display.
+    Since podcast and episode descriptions are sent as captions to the artwork,
+    their length is limited to 1000 chars.
+
+    This ensures that the provided string is shorter than 1000 chars by appropriately
+    truncating everything past that threshold. Tags that the cut leaves open are closed,
+    since Telegram rejects captions with unbalanced HTML.
+    """
+    if len(s) < MAX_CAPTION_LENGTH:
+        return s
+    res = ''
+    s_s = s.split('\n')
+    i = 0
+    while (len(res) < MAX_CAPTION_LENGTH) and (len(s_s[i]) < (MAX_CAPTION_LENGTH - len(res))):
+        res += s_s[i] + '\n'
+        i += 1
+    res = res[:-1] + '…'
+
+    return html_sanitizer.close_open_tags(res)
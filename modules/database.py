@@ -7,8 +7,22 @@ to interface with the database.
 """
 
 import sqlite3
+import threading
+from contextlib import contextmanager
 
-from . import tools, entities
+from . import captions
+
+# kinds of file in the media cache
+AUDIO = "audio"
+PHOTO = "photo"
+
+BUSY_TIMEOUT = 10 # seconds to wait for another connection's write lock
+CONNECTION_PRAGMAS = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL", # durable across crashes of the bot, fsyncs only at checkpoints
+        "PRAGMA cache_size = -16000", # 16MB page cache per connection
+        "PRAGMA temp_store = MEMORY"
+    ]
 
 POD_COLUMNS = [
         "pod_id",
@@ -19,7 +33,8 @@ POD_COLUMNS = [
         "image_url",
         "image_file_id",
         "latest_release",
-        "episode_count"
+        "episode_count",
+        "last_synced"
     ]
 
 EP_COLUMNS = [
@@ -33,18 +48,47 @@ EP_COLUMNS = [
         "link",
         "file_id",
         "shownotes",
-        "too_long"
+        "too_long",
+        "guid",
+        "published_ts",
+        "caption"
     ]
 
-class DB:
-    def __init__(self, name="test.db"):
-        self.connection = sqlite3.connect(name, check_same_thread=False)
-        self.cursor = self.connection.cursor()
-
-
-    def initialise(self):
-        tables = {
-            "podcasts": """CREATE TABLE IF NOT EXISTS podcasts
+def add_column(table, column, column_type):
+    """
+    A migration step that adds a column unless it exists already, which is the case for
+    databases created while the schema was versioned by hand.
+    """
+    def step(cursor):
+        existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    return step
+
+
+def render_captions(cursor):
+    """
+    A migration step that renders the captions of stored episodes, in batches.
+    """
+    command = """SELECT ep_id, title, duration, published_str, subtitle, summary FROM episodes
+            WHERE caption IS NULL LIMIT 1000"""
+    while True:
+        rows = cursor.execute(command).fetchall()
+        if not rows:
+            break
+        cursor.executemany("UPDATE episodes SET caption = ?, too_long = ?, shownotes = ? WHERE ep_id = ?",
+                           [captions.render_episode_caption(title, duration, published_str, subtitle or '', summary or '')
+                            + (ep_id,) for ep_id, title, duration, published_str, subtitle, summary in rows])
+
+
+# Schema history. The database's PRAGMA user_version is the number of migrations applied.
+# Only ever append to this list: migrations that have shipped must not change.
+MIGRATIONS = [
+    {
+        "description": "initial schema",
+        "steps": [
+            """CREATE TABLE IF NOT EXISTS podcasts
                     (pod_id INTEGER PRIMARY KEY,
                     title TEXT,
                     artist TEXT,
@@ -55,7 +99,7 @@ class DB:
                     latest_release TEXT,
                     episode_count TEXT)""",
 
-            "episodes": """CREATE TABLE IF NOT EXISTS episodes
+            """CREATE TABLE IF NOT EXISTS episodes
                     (ep_id INTEGER PRIMARY KEY,
                     pod_id INTEGER,
                     title TEXT,
@@ -69,31 +113,316 @@ class DB:
                     too_long TEXT,
                     FOREIGN KEY(pod_id) REFERENCES podcasts(pod_id))""",
 
-            "users": """CREATE TABLE IF NOT EXISTS users
+            """CREATE TABLE IF NOT EXISTS users
                     (user_id INTEGER PRIMARY KEY)""",
 
-            "subscriptions": """CREATE TABLE IF NOT EXISTS subscriptions
-                            (user_id INTEGER,
-                            pod_id INTEGER,
-                            latest_release TEXT,
-                            FOREIGN KEY(user_id) REFERENCES users(user_id),
-                            FOREIGN KEY(pod_id) REFERENCES podcasts(pod_id))"""
-        }
+            """CREATE TABLE IF NOT EXISTS subscriptions
+                    (user_id INTEGER,
+                    pod_id INTEGER,
+                    latest_release TEXT,
+                    FOREIGN KEY(user_id) REFERENCES users(user_id),
+                    FOREIGN KEY(pod_id) REFERENCES podcasts(pod_id))"""
+        ]
+    },
+    {
+        "description": "incremental episode sync",
+        "steps": [
+            add_column("podcasts", "last_synced", "INTEGER"),
+            add_column("episodes", "guid", "TEXT"),
+            add_column("episodes", "published_ts", "INTEGER")
+        ]
+    },
+    {
+        "description": "feed cache, upload jobs and file ID cache",
+        "steps": [
+            """CREATE TABLE IF NOT EXISTS feeds
+                    (feed_url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_type TEXT,
+                    body BLOB)""",
+
+            """CREATE TABLE IF NOT EXISTS upload_jobs
+                    (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ep_id INTEGER,
+                    path TEXT,
+                    status TEXT,
+                    file_id TEXT,
+                    error TEXT,
+                    created_at INTEGER,
+                    updated_at INTEGER,
+                    FOREIGN KEY(ep_id) REFERENCES episodes(ep_id))""",
+
+            """CREATE TABLE IF NOT EXISTS media_cache
+                    (url_key TEXT PRIMARY KEY,
+                    file_id TEXT,
+                    size INTEGER)"""
+        ]
+    },
+    {
+        "description": "indexes for episode lists and subscriptions",
+        "steps": [
+            """CREATE INDEX IF NOT EXISTS episodes_by_podcast
+                    ON episodes (pod_id, published_ts DESC, ep_id)""",
+
+            # keep the earliest of any duplicate subscriptions before enforcing uniqueness
+            """DELETE FROM subscriptions WHERE rowid NOT IN
+                    (SELECT MIN(rowid) FROM subscriptions GROUP BY user_id, pod_id)""",
+
+            """CREATE UNIQUE INDEX IF NOT EXISTS subscriptions_by_user
+                    ON subscriptions (user_id, pod_id)""",
+
+            """CREATE INDEX IF NOT EXISTS subscriptions_by_podcast
+                    ON subscriptions (pod_id)"""
+        ]
+    },
+    {
+        "description": "full-text search over podcasts and episodes",
+        "steps": [
+            # external content tables: the index stores only tokens, the text stays in podcasts/episodes
+            """CREATE VIRTUAL TABLE IF NOT EXISTS podcasts_fts USING fts5
+                    (title, artist, subtitle,
+                    content='podcasts', content_rowid='pod_id',
+                    tokenize='unicode61 remove_diacritics 2')""",
+
+            """CREATE VIRTUAL TABLE IF NOT EXISTS episodes_fts USING fts5
+                    (title, subtitle, summary,
+                    content='episodes', content_rowid='ep_id',
+                    tokenize='unicode61 remove_diacritics 2')""",
+
+            """CREATE TRIGGER IF NOT EXISTS podcasts_fts_insert AFTER INSERT ON podcasts BEGIN
+                    INSERT INTO podcasts_fts (rowid, title, artist, subtitle)
+                        VALUES (new.pod_id, new.title, new.artist, new.subtitle);
+                END""",
+
+            """CREATE TRIGGER IF NOT EXISTS podcasts_fts_delete AFTER DELETE ON podcasts BEGIN
+                    INSERT INTO podcasts_fts (podcasts_fts, rowid, title, artist, subtitle)
+                        VALUES ('delete', old.pod_id, old.title, old.artist, old.subtitle);
+                END""",
+
+            # only the indexed columns, so sync watermarks and file IDs don't reindex the row
+            """CREATE TRIGGER IF NOT EXISTS podcasts_fts_update AFTER UPDATE OF title, artist, subtitle ON podcasts BEGIN
+                    INSERT INTO podcasts_fts (podcasts_fts, rowid, title, artist, subtitle)
+                        VALUES ('delete', old.pod_id, old.title, old.artist, old.subtitle);
+                    INSERT INTO podcasts_fts (rowid, title, artist, subtitle)
+                        VALUES (new.pod_id, new.title, new.artist, new.subtitle);
+                END""",
+
+            """CREATE TRIGGER IF NOT EXISTS episodes_fts_insert AFTER INSERT ON episodes BEGIN
+                    INSERT INTO episodes_fts (rowid, title, subtitle, summary)
+                        VALUES (new.ep_id, new.title, new.subtitle, new.summary);
+                END""",
+
+            """CREATE TRIGGER IF NOT EXISTS episodes_fts_delete AFTER DELETE ON episodes BEGIN
+                    INSERT INTO episodes_fts (episodes_fts, rowid, title, subtitle, summary)
+                        VALUES ('delete', old.ep_id, old.title, old.subtitle, old.summary);
+                END""",
+
+            """CREATE TRIGGER IF NOT EXISTS episodes_fts_update AFTER UPDATE OF title, subtitle, summary ON episodes BEGIN
+                    INSERT INTO episodes_fts (episodes_fts, rowid, title, subtitle, summary)
+                        VALUES ('delete', old.ep_id, old.title, old.subtitle, old.summary);
+                    INSERT INTO episodes_fts (rowid, title, subtitle, summary)
+                        VALUES (new.ep_id, new.title, new.subtitle, new.summary);
+                END""",
+
+            # index everything stored before the triggers existed
+            "INSERT INTO podcasts_fts (podcasts_fts) VALUES ('rebuild')",
+            "INSERT INTO episodes_fts (episodes_fts) VALUES ('rebuild')"
+        ]
+    },
+    {
+        "description": "episode captions rendered at ingest",
+        "steps": [
+            add_column("episodes", "caption", "TEXT"),
+            render_captions
+        ]
+    },
+    {
+        "description": "resumable episode jobs",
+        "steps": [
+            """CREATE TABLE IF NOT EXISTS episode_jobs
+                    (ep_id INTEGER PRIMARY KEY,
+                    pod_id INTEGER,
+                    state TEXT,
+                    file_id TEXT,
+                    error TEXT,
+                    created_at INTEGER,
+                    updated_at INTEGER,
+                    FOREIGN KEY(ep_id) REFERENCES episodes(ep_id))""",
+
+            """CREATE TABLE IF NOT EXISTS episode_job_chats
+                    (ep_id INTEGER,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    PRIMARY KEY (ep_id, chat_id),
+                    FOREIGN KEY(ep_id) REFERENCES episode_jobs(ep_id))""",
+
+            """CREATE INDEX IF NOT EXISTS episode_jobs_by_state
+                    ON episode_jobs (state)"""
+        ]
+    },
+    {
+        "description": "episode captions re-rendered with escaped titles and balanced tags",
+        "steps": [
+            "UPDATE episodes SET caption = NULL",
+            render_captions
+        ]
+    },
+    {
+        "description": "kinds of file in the media cache",
+        "steps": [
+            """CREATE TABLE IF NOT EXISTS media_cache_by_kind
+                    (url_key TEXT,
+                    kind TEXT,
+                    file_id TEXT,
+                    size INTEGER,
+                    PRIMARY KEY (kind, url_key))""",
+
+            # artwork was cached under its URL, audio under a normalised URL without a scheme
+            """INSERT OR REPLACE INTO media_cache_by_kind (url_key, kind, file_id, size)
+                    SELECT url_key, CASE WHEN url_key LIKE '%://%' THEN 'photo' ELSE 'audio' END, file_id, size
+                    FROM media_cache""",
+
+            "DROP TABLE media_cache",
+            "ALTER TABLE media_cache_by_kind RENAME TO media_cache"
+        ]
+    }
+]
+
+TABLE_KEYS = {
+        "podcasts": "pod_id",
+        "episodes": "ep_id",
+        "upload_jobs": "job_id",
+        "episode_jobs": "ep_id"
+    }
+
+class DB:
+    """
+    Every thread gets its own connection and cursor, opened on first use, so statements from
+    concurrent handlers never interleave on a shared cursor. In WAL mode readers don't wait
+    for writers, and writers wait up to BUSY_TIMEOUT for each other instead of failing.
+    """
+    def __init__(self, name="test.db"):
+        self.name = name
+        self.local = threading.local()
+
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.name, timeout=BUSY_TIMEOUT)
+            for pragma in CONNECTION_PRAGMAS:
+                connection.execute(pragma)
+            self.local.connection = connection
+            self.local.cursor = connection.cursor()
+            self.local.transaction_depth = 0
+        return connection
+
+
+    @property
+    def cursor(self):
+        self.connection # opens this thread's connection if there isn't one yet
+        return self.local.cursor
+
+
+    @property
+    def transaction_depth(self):
+        return getattr(self.local, "transaction_depth", 0)
+
+
+    @transaction_depth.setter
+    def transaction_depth(self, depth):
+        self.local.transaction_depth = depth
+
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups all writes made inside the block into a single transaction, committed on exit
+        and rolled back if the block raises. Nested blocks join the outermost transaction.
+
+        The write lock is taken up front, so a transaction that reads before writing can't
+        fail halfway through on a lock held by another thread's connection.
+        """
+        if self.transaction_depth == 0 and not self.connection.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        self.transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.rollback()
+                print("TRANSACTION ROLLED BACK.")
+            raise
+        else:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.commit()
+
+
+    def commit(self):
+        """
+        Commits, unless called inside a transaction block, which commits on exit instead.
+        """
+        if self.transaction_depth == 0:
+            self.connection.commit()
 
-        for table in tables:
-            self.cursor.execute(tables[table])
 
-        self.connection.commit()
+    def initialise(self):
+        """
+        Brings the schema up to date by applying the migrations newer than the database's
+        user_version, each in its own transaction.
+        """
+        version = next(self.cursor.execute("PRAGMA user_version"))[0]
+        for migration in MIGRATIONS[version:]:
+            try:
+                self.cursor.execute("BEGIN")
+                for step in migration["steps"]:
+                    if callable(step):
+                        step(self.cursor)
+                    else:
+                        self.cursor.execute(step)
+                version += 1
+                self.cursor.execute(f"PRAGMA user_version = {version}")
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                print(f"MIGRATION FAILED: version {version + 1}, {migration['description']}.")
+                raise
+            print(f"MIGRATED DATABASE: version {version}, {migration['description']}.")
+
         print("INITIAL SETUP: done.")
 
 
     def add_podcast(self, pod_data: tuple):
-        command = "INSERT INTO podcasts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        command = f"INSERT INTO podcasts VALUES ({', '.join('?' * len(POD_COLUMNS))})"
         self.cursor.execute(command, pod_data)
-        self.connection.commit()
+        self.commit()
         print(f"ADDED PODCAST: added {pod_data[1]}.")
 
 
+    def upsert_podcasts(self, pods_data: list):
+        """
+        Inserts many podcasts at once. Podcasts that are already stored get their iTunes metadata
+        refreshed, while the fields filled in from the feed are kept. The stored artwork file ID is
+        dropped if the artwork URL has changed.
+        """
+        command = f"""INSERT INTO podcasts VALUES ({', '.join('?' * len(POD_COLUMNS))})
+                ON CONFLICT(pod_id) DO UPDATE SET
+                    title = excluded.title,
+                    artist = excluded.artist,
+                    feed_url = excluded.feed_url,
+                    image_file_id = CASE WHEN image_url = excluded.image_url THEN image_file_id END,
+                    image_url = excluded.image_url,
+                    latest_release = excluded.latest_release,
+                    episode_count = excluded.episode_count"""
+        self.cursor.executemany(command, pods_data)
+        self.commit()
+        print(f"UPSERTED PODCASTS: {len(pods_data)} podcasts.")
+
+
     def get_podcast(self, pod_id: str):
         args = (int(pod_id),)
         command = "SELECT * FROM podcasts WHERE pod_id = ?"
@@ -105,6 +434,56 @@ class DB:
             return None
 
 
+    def get_podcasts(self, pod_ids: list):
+        """
+        Fetches many podcasts with one query. Rows are returned in the order of pod_ids,
+        skipping podcasts that aren't stored.
+        """
+        pod_ids = [int(pod_id) for pod_id in pod_ids]
+        rows = dict()
+        print(f"LOOKING FOR PODCASTS: {len(pod_ids)} podcasts.")
+        # older SQLite builds allow at most 999 parameters per statement
+        for i in range(0, len(pod_ids), 900):
+            chunk = pod_ids[i:i + 900]
+            command = f"SELECT * FROM podcasts WHERE pod_id IN ({', '.join('?' * len(chunk))})"
+            rows.update((row[0], row) for row in self.cursor.execute(command, chunk))
+
+        return [rows[pod_id] for pod_id in pod_ids if pod_id in rows]
+
+
+    def search_podcasts(self, match_query: str, limit):
+        """
+        Searches stored podcasts with an FTS5 query, best matches first.
+        Title matches rank above artist matches, which rank above subtitle matches.
+        """
+        args = (match_query, int(limit),)
+        command = """SELECT podcasts.* FROM podcasts_fts
+                JOIN podcasts ON podcasts.pod_id = podcasts_fts.rowid
+                WHERE podcasts_fts MATCH ?
+                ORDER BY bm25(podcasts_fts, 10.0, 5.0, 1.0) LIMIT ?"""
+
+        print(f"SEARCHING PODCASTS: {match_query}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
+    def get_podcast_and_episode(self, pod_id: str, ep_id: str):
+        """
+        Fetches a podcast and one of its episodes with one query. Returns a tuple of
+        the podcast row and the episode row, or None.
+        """
+        args = (int(ep_id), int(pod_id),)
+        command = """SELECT podcasts.*, episodes.* FROM episodes
+                JOIN podcasts ON podcasts.pod_id = episodes.pod_id
+                WHERE episodes.ep_id = ? AND podcasts.pod_id = ?"""
+        try:
+            print(f"LOOKING FOR EPISODE: {ep_id} of podcast {pod_id}.")
+            row = next(self.cursor.execute(command, args))
+            return row[:len(POD_COLUMNS)], row[len(POD_COLUMNS):]
+        except StopIteration:
+            print(f"EPISODE NOT FOUND: {ep_id} of podcast {pod_id} not in database.")
+            return None
+
+
     def episodes_are_stored(self, pod_id: str):
         args = (int(pod_id),)
         command = "SELECT 1 FROM episodes WHERE pod_id = ?"
@@ -117,12 +496,19 @@ class DB:
 
 
     def add_episode(self, ep_data: tuple):
-        command = "INSERT INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        command = f"INSERT INTO episodes VALUES ({', '.join('?' * len(EP_COLUMNS))})"
         self.cursor.execute(command, ep_data)
-        self.connection.commit()
+        self.commit()
         print(f"ADDED EPISODE: {ep_data[2]}.")
 
 
+    def add_episodes(self, eps_data: list):
+        command = f"INSERT INTO episodes VALUES ({', '.join('?' * len(EP_COLUMNS))})"
+        self.cursor.executemany(command, eps_data)
+        self.commit()
+        print(f"ADDED EPISODES: {len(eps_data)} episodes.")
+
+
     def get_episode(self, ep_id: str):
         args = (int(ep_id),)
         command = "SELECT * FROM episodes WHERE ep_id = ?"
@@ -135,23 +521,40 @@ class DB:
 
 
     def update_item_in_table(self, item_id, table_name, columns_to_update: dict):
-        columns = list(columns_to_update.keys())
-        values = list(columns_to_update.values())
-        args = []
+        command = self.generate_update_command(table_name, list(columns_to_update.keys()))
+        args = list(columns_to_update.values()) + [int(item_id)]
+
+        self.cursor.execute(command, tuple(args))
+        self.commit()
+        print(f"UPDATED TABLE {table_name.upper()}: item {item_id}.")
+
+
+    def update_items_in_table(self, table_name, items_to_update: dict):
+        """
+        items_to_update maps item IDs to dicts of columns to update. Items updating the same set
+        of columns share a single executemany call.
+        """
+        batches = dict()
+        for item_id, columns_to_update in items_to_update.items():
+            columns = tuple(columns_to_update.keys())
+            args = tuple(columns_to_update.values()) + (int(item_id),)
+            batches.setdefault(columns, []).append(args)
+
+        for columns, args_list in batches.items():
+            self.cursor.executemany(self.generate_update_command(table_name, list(columns)), args_list)
+        self.commit()
+        print(f"UPDATED TABLE {table_name.upper()}: {len(items_to_update)} items.")
+
+
+    def generate_update_command(self, table_name, columns: list):
         command_start = f"UPDATE {table_name} SET "
-        command_middle = "" # generated with columns_to_update
-        command_end = f"WHERE {'pod_id' if table_name == 'podcasts' else 'ep_id'} = ?" # ? is item_id
+        command_middle = "" # generated with columns
+        command_end = f"WHERE {TABLE_KEYS[table_name]} = ?" # ? is item_id
 
         for i, column in enumerate(columns):
             command_middle += f"{column} = ?" + (", " if i < len(columns) - 1 else " ")
-            args.append(values[i])
-
-        args.append(int(item_id))
-        command = command_start + command_middle + command_end
 
-        self.cursor.execute(command, tuple(args))
-        self.connection.commit()
-        print(f"UPDATED TABLE {table_name.upper()}: item {item_id}.")
+        return command_start + command_middle + command_end
 
 
     def get_all_podcasts(self):
@@ -165,7 +568,7 @@ class DB:
 
 
     def get_all_episodes(self, pod_id):
-        command = "SELECT * FROM episodes WHERE pod_id = ?"
+        command = "SELECT * FROM episodes WHERE pod_id = ? ORDER BY published_ts DESC, ep_id"
         args = (int(pod_id),)
         try:
             print(f"GETTING ALL EPISODES: for podcast {pod_id}.")
@@ -175,6 +578,40 @@ class DB:
             return None
 
 
+    def count_episodes(self, pod_id):
+        args = (int(pod_id),)
+        command = "SELECT COUNT(*) FROM episodes WHERE pod_id = ?"
+
+        print(f"COUNTING EPISODES: for podcast {pod_id}.")
+        return next(self.cursor.execute(command, args))[0]
+
+
+    def get_episodes_page(self, pod_id, limit, offset):
+        """
+        Fetches one page of a podcast's episodes, newest first, walking the episodes_by_podcast index.
+        """
+        args = (int(pod_id), int(limit), int(offset),)
+        command = """SELECT * FROM episodes WHERE pod_id = ?
+                ORDER BY published_ts DESC, ep_id LIMIT ? OFFSET ?"""
+
+        print(f"GETTING EPISODES PAGE: for podcast {pod_id}, offset {offset}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
+    def search_episodes(self, pod_id, match_query: str, limit):
+        """
+        Searches the stored episodes of one podcast with an FTS5 query, best matches first.
+        """
+        args = (match_query, int(pod_id), int(limit),)
+        command = """SELECT episodes.* FROM episodes_fts
+                JOIN episodes ON episodes.ep_id = episodes_fts.rowid
+                WHERE episodes_fts MATCH ? AND episodes.pod_id = ?
+                ORDER BY bm25(episodes_fts, 10.0, 2.0, 1.0) LIMIT ?"""
+
+        print(f"SEARCHING EPISODES: podcast {pod_id}, {match_query}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
     def is_subscribed_to(self, user_id, pod_id):
         args = (int(user_id), int(pod_id),)
         command = "SELECT 1 FROM subscriptions WHERE user_id = ? AND pod_id = ?"
@@ -189,10 +626,10 @@ class DB:
 
     def subscribe_user_to_podcast(self, user_id, pod_id, latest_release):
         args = (int(user_id), int(pod_id), latest_release,)
-        command = "INSERT INTO subscriptions VALUES (?, ?, ?)"
+        command = "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?)"
 
         self.cursor.execute(command, args)
-        self.connection.commit()
+        self.commit()
         print(f"USER SUBSCRIBED TO PODCAST: user {user_id}, podcast {pod_id}.")
 
 
@@ -201,7 +638,7 @@ class DB:
         command = "DELETE FROM subscriptions WHERE user_id = ? AND pod_id = ?"
 
         self.cursor.execute(command, args)
-        self.connection.commit()
+        self.commit()
         print(f"USER UNSUBSCRIBED FROM PODCAST: user {user_id}, podcast {pod_id}.")
 
 
@@ -217,5 +654,183 @@ class DB:
             return None
 
 
+    def get_subscribed_podcasts(self, user_id, limit=-1, offset=0):
+        """
+        Fetches the podcasts a user is subscribed to with one query, in subscription order.
+        All of them by default, or one page given a limit and offset.
+        """
+        args = (int(user_id), int(limit), int(offset),)
+        command = """SELECT podcasts.* FROM subscriptions
+                JOIN podcasts ON podcasts.pod_id = subscriptions.pod_id
+                WHERE subscriptions.user_id = ?
+                ORDER BY subscriptions.rowid LIMIT ? OFFSET ?"""
+
+        print(f"GETTING SUBSCRIBED PODCASTS FOR USER: {user_id}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
+    def count_subscriptions(self, user_id):
+        args = (int(user_id),)
+        command = "SELECT COUNT(*) FROM subscriptions WHERE user_id = ?"
+
+        print(f"COUNTING SUBSCRIPTIONS FOR USER: {user_id}.")
+        return next(self.cursor.execute(command, args))[0]
+
+
+    def get_subscribed_pod_ids(self):
+        """
+        Returns the IDs of all podcasts that have at least one subscriber.
+        """
+        command = "SELECT DISTINCT pod_id FROM subscriptions"
+
+        print("GETTING SUBSCRIBED PODCASTS.")
+        return [x[0] for x in self.cursor.execute(command)]
+
+
+    def get_subscribers(self, pod_id):
+        args = (int(pod_id),)
+        command = "SELECT user_id FROM subscriptions WHERE pod_id = ?"
+
+        print(f"GETTING SUBSCRIBERS FOR PODCAST: {pod_id}.")
+        return [x[0] for x in self.cursor.execute(command, args)]
+
+
+    def get_prefetch_candidates(self, published_since, min_subscribers, limit):
+        """
+        Returns (episode row, subscriber count) for the episodes published since published_since that
+        have no file ID yet, of podcasts with at least min_subscribers subscribers, most subscribed first.
+        """
+        args = (published_since, min_subscribers, limit,)
+        command = """SELECT episodes.*, COUNT(*) AS subscribers FROM episodes
+                JOIN subscriptions ON subscriptions.pod_id = episodes.pod_id
+                WHERE episodes.file_id IS NULL AND episodes.published_ts >= ?
+                GROUP BY episodes.ep_id HAVING subscribers >= ?
+                ORDER BY subscribers DESC, episodes.published_ts DESC LIMIT ?"""
+
+        print(f"GETTING PREFETCH CANDIDATES: published since {published_since}.")
+        return [(row[:-1], row[-1]) for row in self.cursor.execute(command, args)]
+
+
+    def get_cached_feed(self, feed_url):
+        args = (feed_url,)
+        command = "SELECT etag, last_modified, content_type, body FROM feeds WHERE feed_url = ?"
+        try:
+            print(f"LOOKING FOR CACHED FEED: {feed_url}.")
+            return next(self.cursor.execute(command, args))
+        except StopIteration:
+            print(f"FEED NOT CACHED: {feed_url}.")
+            return None
+
+
+    def store_cached_feed(self, feed_url, etag, last_modified, content_type, body: bytes):
+        args = (feed_url, etag, last_modified, content_type, sqlite3.Binary(body),)
+        command = "INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?)"
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"CACHED FEED: {feed_url}, {len(body)} bytes compressed.")
+
+
+    def add_upload_job(self, ep_id, path, status, created_at):
+        args = (int(ep_id), str(path), status, created_at, created_at,)
+        command = """INSERT INTO upload_jobs (ep_id, path, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)"""
+
+        self.cursor.execute(command, args)
+        job_id = self.cursor.lastrowid
+        self.commit()
+        print(f"ADDED UPLOAD JOB: job {job_id}, episode {ep_id}.")
+        return job_id
+
+
+    def start_episode_job(self, ep_id, pod_id, state, started_at):
+        """
+        Records a job for an episode, or restarts the episode's previous job in the given state.
+        """
+        args = (int(ep_id), int(pod_id), state, started_at, started_at,)
+        command = """INSERT INTO episode_jobs (ep_id, pod_id, state, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(ep_id) DO UPDATE SET
+                    state = excluded.state,
+                    error = NULL,
+                    updated_at = excluded.updated_at"""
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"STARTED EPISODE JOB: episode {ep_id}, {state}.")
+
+
+    def update_episode_job_state(self, ep_id, old_state, new_state, updated_at):
+        """
+        Moves a job to new_state, only if it's still in old_state.
+        """
+        args = (new_state, updated_at, int(ep_id), old_state,)
+        command = "UPDATE episode_jobs SET state = ?, updated_at = ? WHERE ep_id = ? AND state = ?"
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"UPDATED EPISODE JOB: episode {ep_id}, {old_state} -> {new_state}.")
+
+
+    def get_episode_jobs(self, states: list):
+        args = tuple(states)
+        command = f"SELECT * FROM episode_jobs WHERE state IN ({', '.join('?' * len(states))})"
+
+        print(f"GETTING EPISODE JOBS: {', '.join(states)}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
+    def add_episode_job_chat(self, ep_id, chat_id, message_id):
+        args = (int(ep_id), int(chat_id), message_id,)
+        command = "INSERT OR REPLACE INTO episode_job_chats VALUES (?, ?, ?)"
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"CHAT WAITING FOR EPISODE: chat {chat_id}, episode {ep_id}.")
+
+
+    def remove_episode_job_chat(self, ep_id, chat_id):
+        args = (int(ep_id), int(chat_id),)
+        command = "DELETE FROM episode_job_chats WHERE ep_id = ? AND chat_id = ?"
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"CHAT NO LONGER WAITING FOR EPISODE: chat {chat_id}, episode {ep_id}.")
+
+
+    def get_episode_job_chats(self, ep_id):
+        """
+        Returns a list of (chat_id, message_id) of the chats waiting for an episode.
+        """
+        args = (int(ep_id),)
+        command = "SELECT chat_id, message_id FROM episode_job_chats WHERE ep_id = ?"
+
+        print(f"GETTING CHATS WAITING FOR EPISODE: {ep_id}.")
+        return [x for x in self.cursor.execute(command, args)]
+
+
+    def get_cached_file_id(self, kind, url_key):
+        """
+        Returns the file ID of the AUDIO or PHOTO file already uploaded from url_key, or None.
+        """
+        args = (kind, url_key,)
+        command = "SELECT file_id FROM media_cache WHERE kind = ? AND url_key = ?"
+        try:
+            print(f"LOOKING FOR CACHED FILE ID: {kind}, {url_key}.")
+            return next(self.cursor.execute(command, args))[0]
+        except StopIteration:
+            print(f"FILE ID NOT CACHED: {kind}, {url_key}.")
+            return None
+
+
+    def cache_file_id(self, kind, url_key, file_id, size):
+        args = (url_key, kind, file_id, size,)
+        command = "INSERT OR REPLACE INTO media_cache (url_key, kind, file_id, size) VALUES (?, ?, ?, ?)"
+
+        self.cursor.execute(command, args)
+        self.commit()
+        print(f"CACHED FILE ID: {kind}, {url_key}.")
+
+
 db = DB("bot.db")
 db.initialise()
\ No newline at end of file
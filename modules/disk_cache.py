@@ -0,0 +1,165 @@
+"""
+disk_cache.py
+
+A byte quota for a working directory of large files, with least-recently-used eviction.
+
+Files are grouped into entries by the part of their name before the first dot, so an episode's audio
+and its download state (1234.mp3 and 1234.mp3.parts) are counted, used and evicted together. The
+directory is scanned whenever room is needed, so files written or removed by other code are accounted
+for without being registered. Entries in use are never evicted, and an entry's last use is the
+latest modification time of its files.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+
+class CacheFull(Exception):
+    pass
+
+
+class DiskCache:
+    """
+    Keeps the files in root under quota bytes. Before a file is written, reserve makes room for it
+    by removing the entries that were used least recently, or raises CacheFull if the entries in
+    use leave no room. sweep removes everything that isn't needed any more, e.g. on startup.
+    """
+    def __init__(self, root, quota, max_age):
+        self.root = Path(root)
+        self.quota = quota
+        self.max_age = max_age
+        self.lock = Lock()
+        self.in_use = {} # key: number of users
+        self.reserved = {} # key: bytes the entry will take up once written
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.refusals = 0
+
+
+    @contextmanager
+    def use(self, key):
+        """
+        Protects the entry from eviction while it's used, and marks it as used now.
+        """
+        key = str(key)
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock:
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            for path in self.scan().get(key, (0, 0, []))[2]:
+                _touch(path)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_use[key] -= 1
+                if not self.in_use[key]:
+                    del self.in_use[key]
+                    self.reserved.pop(key, None)
+
+
+    def reserve(self, key, n_bytes, limit=None):
+        """
+        Makes room for the entry to take up n_bytes. Only call this for an entry in use.
+        With a limit, the entries may only take up that many bytes of the quota afterwards,
+        so that background downloads leave the rest of it to the downloads users wait for.
+        """
+        key = str(key)
+        limit = self.quota if limit is None else min(limit, self.quota)
+        with self.lock:
+            entries = self.scan()
+            self.reserved[key] = n_bytes
+            usage = self.usage(entries)
+            evictable = sorted((last_used, entry_key) for entry_key, (_, last_used, _) in entries.items()
+                               if entry_key not in self.in_use)
+            while usage > limit and evictable:
+                _, entry_key = evictable.pop(0)
+                size, _, paths = entries.pop(entry_key)
+                _remove(paths)
+                usage -= size
+                self.evictions += 1
+                self.evicted_bytes += size
+                print(f"EVICTED FROM DISK CACHE: {entry_key}, {size} bytes.")
+
+            if usage > limit:
+                del self.reserved[key]
+                self.refusals += 1
+                raise CacheFull(f"{n_bytes} bytes for {key} don't fit in {limit} bytes of the {self.quota} byte quota of {self.root}")
+
+
+    def sweep(self, keep):
+        """
+        Removes the entries whose keys aren't in keep, the entries that weren't used for max_age,
+        and temporary files. Entries in use are left alone.
+        """
+        keep = {str(key) for key in keep}
+        now = time.time()
+        with self.lock:
+            for key, (_, last_used, paths) in self.scan().items():
+                if key in self.in_use:
+                    continue
+                if key not in keep or now - last_used > self.max_age:
+                    _remove(paths)
+                    print(f"SWEPT FROM DISK CACHE: {', '.join(path.name for path in paths)}.")
+                else:
+                    _remove([path for path in paths if path.name.endswith(".tmp")])
+        print(f"DISK CACHE: {self.stats()}.")
+
+
+    def scan(self):
+        """
+        Returns {key: (total size, last used, [paths])} for the entries on disk.
+        """
+        entries = {}
+        if not self.root.exists():
+            return entries
+        for path in self.root.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue # removed since it was listed
+            if not path.is_file():
+                continue
+            key = path.name.split('.')[0]
+            size, last_used, paths = entries.get(key, (0, 0, []))
+            entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime), paths + [path])
+        return entries
+
+
+    def usage(self, entries):
+        """
+        Entries that are being written count with the size they'll have once complete.
+        """
+        keys = set(entries) | set(self.reserved)
+        return sum(max(entries.get(key, (0,))[0], self.reserved.get(key, 0)) for key in keys)
+
+
+    def stats(self):
+        with self.lock:
+            entries = self.scan()
+            return {
+                "entries": len(entries),
+                "bytes": self.usage(entries),
+                "quota": self.quota,
+                "in_use": len(self.in_use),
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "refusals": self.refusals
+            }
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
@@ -2,36 +2,49 @@
 entities.py
 
 Podcast and Episode classes that represent podcasts and episodes respectively.
+
+Both are slotted, with one slot per database column, and are built from fetched rows with
+from_row, which assigns the row's values to the slots in column order.
 """
 
-from . import tools
+from . import tools, captions
 from .database import POD_COLUMNS, EP_COLUMNS
 
 class Pod:
-    def __init__(self, pod_info, new=True):
+    __slots__ = tuple(POD_COLUMNS) + ("valid",)
+
+    def __init__(self, pod_info):
         try:
-            if new:
-                self.pod_id = str(pod_info['collectionId'])
-                self.title = pod_info['collectionName']
-                self.artist = pod_info['artistName']
-                self.feed_url = pod_info['feedUrl']
-                self.subtitle = None
-                self.image_url = pod_info['artworkUrl600']
-                self.image_file_id = None
-                self.latest_release = tools.prettify_latest_release_date(pod_info['releaseDate'])
-                self.episode_count = pod_info['trackCount']
-                self.valid = True
-            else:
-                for attr in POD_COLUMNS:
-                    setattr(self, attr, pod_info[attr])
+            self.pod_id = str(pod_info['collectionId'])
+            self.title = pod_info['collectionName']
+            self.artist = pod_info['artistName']
+            self.feed_url = pod_info['feedUrl']
+            self.subtitle = None
+            self.image_url = pod_info['artworkUrl600']
+            self.image_file_id = None
+            self.latest_release = tools.prettify_latest_release_date(pod_info['releaseDate'])
+            self.episode_count = pod_info['trackCount']
+            self.last_synced = None
+            self.valid = True
         except KeyError:
             self.valid = False
+
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a Pod from a row of the podcasts table, a tuple or sqlite3.Row in POD_COLUMNS order.
+        """
+        pod = cls.__new__(cls)
+        for attr, value in zip(POD_COLUMNS, row):
+            setattr(pod, attr, value)
+        return pod
         
 
     def __repr__(self):
         result = ''
-        for attr, value in self.__dict__.items():
-            result += f"{attr}: {value}\n"
+        for attr in self.__slots__:
+            result += f"{attr}: {getattr(self, attr, None)}\n"
         return result
 
 
@@ -43,50 +56,62 @@ class Pod:
 class Episode:
     """
     Episode IDs are generated by appending the episode's index to the parent podcast's ID.
+
+    The guid identifies an episode across feed refreshes. Feeds without guids fall back to the
+    episode's source link.
+
+    The caption shown in the episode view is rendered once, when the episode is fetched, and
+    stored along with the too_long flag and show notes, so viewing an episode only reads them.
     """
-    def __init__(self, ep_info, pod_id=None, ep_index=None, new=True):
-        if new:
-            self.ep_id = str(pod_id) + str(ep_index)
-            self.pod_id = pod_id
-            self.title = ep_info['title']
-            self.subtitle, self.summary = tools.get_episode_subtitle_and_summary(ep_info)
-            self.published_date = tools.process_ep_date(ep_info['published'])
-            self.published_str = self.published_date.strftime('%d %B %Y')
-            self.duration = tools.get_ep_duration(ep_info)
-            self.link = tools.get_ep_source_link(ep_info['links'])
-            self.shownotes = ''
-            self.too_long = False
-            self.file_id = None
-        else:
-            for attr in EP_COLUMNS:
-                    setattr(self, attr, ep_info[attr])
-        
+    __slots__ = tuple(EP_COLUMNS)
+
+    def __init__(self, ep_info, pod_id, ep_index):
+        self.ep_id = str(pod_id) + str(ep_index)
+        self.pod_id = pod_id
+        self.title = ep_info['title']
+        self.subtitle, self.summary = tools.get_episode_subtitle_and_summary(ep_info)
+        published_date = tools.process_ep_date(ep_info['published'])
+        self.published_str = published_date.strftime('%d %B %Y')
+        self.published_ts = int(published_date.timestamp())
+        self.duration = tools.get_ep_duration(ep_info)
+        self.link = tools.get_ep_source_link(ep_info['links'])
+        self.shownotes = ''
+        self.too_long = False
+        self.file_id = None
+        self.guid = ep_info.get('id') or self.link
+        self.render_caption()
+
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds an Episode from a row of the episodes table, a tuple or sqlite3.Row in EP_COLUMNS order.
+        """
+        ep = cls.__new__(cls)
+        for attr, value in zip(EP_COLUMNS, row):
+            setattr(ep, attr, value)
+        return ep
+
 
     def __repr__(self):
         txt = ''
-        for attr, value in self.__dict__.items():
-            txt += f"{attr}: {value}\n"
+        for attr in self.__slots__:
+            txt += f"{attr}: {getattr(self, attr, None)}\n"
         return txt
     
 
-    def is_chosen(self):
-        description = self.summary if len(self.subtitle) == 0 else self.subtitle
-
-        self.too_long = False
-        if 0 < len(self.subtitle) < len(self.summary):
-            self.too_long = True
-            self.shownotes = self.summary
-        
-        description_truncated = tools.truncate(description)
-        
-        if len(description_truncated) < len(description):
-            self.too_long = True
-            self.shownotes = description
-        
-        msg = f"<b>{self.title}</b>\n{self.duration}, {self.published_str}\n\n{description_truncated}\n\n"
-        return msg
+    def render_caption(self):
+        """
+        Renders the episode view caption, and works out if the description needs a separate
+        show notes message.
+        """
+        self.caption, self.too_long, self.shownotes = captions.render_episode_caption(
+            self.title, self.duration, self.published_str, self.subtitle, self.summary)
+        return self.caption
     
 
-    def get_file_id(self, pod_title, thumb_id):
-        self.file_id = tools.download_ep(self.link, self.ep_id, self.title, pod_title, thumb_id)
+    def get_file_id(self, pod_title, thumb_id, on_progress=None, disk_limit=None):
+        self.file_id = tools.get_cached_file_id(self.link)
+        if not self.file_id:
+            self.file_id = tools.download_ep(self.link, self.ep_id, self.title, pod_title, thumb_id, on_progress, disk_limit)
         return self.file_id
\ No newline at end of file
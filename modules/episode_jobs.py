@@ -0,0 +1,197 @@
+"""
+episode_jobs.py
+
+Crash-safe delivery of episode audio to the chats that asked for it.
+
+Before an episode is downloaded, a job is recorded in the episode_jobs table, and every chat waiting
+for it in episode_job_chats. A job is DOWNLOADING until its Telegram file ID is known (this covers
+both the download and the upload), then UPLOADED, then DELIVERED once no chat is waiting any more.
+If the bot stops before a job is delivered, resume_pending finishes it on the next start: partial
+downloads continue where they stopped (see range_downloader), and the waiting chats get their audio.
+"""
+
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from requests import RequestException
+from telegram.error import TelegramError, Unauthorized, BadRequest
+
+# Local modules
+from . import tools, range_downloader
+from .database import db
+from .range_downloader import DownloadError
+from .disk_cache import CacheFull
+from .upload_jobs import UploadError
+
+DOWNLOADING = "downloading"
+UPLOADED = "uploaded"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+RESUME_WORKERS = 2
+PROGRESS_EDIT_INTERVAL = 3 # seconds, keeps progress edits well inside Telegram's rate limits
+FETCHING = Counter() # ep_id: number of fetches in progress that chats are waiting for
+FETCHING_LOCK = Lock()
+RESUME_EXECUTOR = ThreadPoolExecutor(max_workers=RESUME_WORKERS, thread_name_prefix="episode-job")
+
+
+def request_episode(bot, chat_id, message_id, pod, ep):
+    """
+    Sends the episode's audio to chat_id, getting its file ID first if needed.
+    message_id is the chat's notification message, which shows the progress and is deleted on delivery.
+    """
+    tracked = not ep.file_id # a known file ID is sent right away, without a job
+    if tracked:
+        with db.transaction():
+            db.start_episode_job(ep.ep_id, pod.pod_id, DOWNLOADING, int(time.time()))
+            db.add_episode_job_chat(ep.ep_id, chat_id, message_id)
+        fetch(bot, pod, ep, [(chat_id, message_id)])
+
+    deliver(bot, pod, ep, chat_id, message_id, tracked)
+
+
+def fetch(bot, pod, ep, chats):
+    """
+    Gets the episode's file ID, reporting progress to the notification messages of the given
+    (chat_id, message_id) chats. On failure the chats are told and stop waiting, and the error is re-raised.
+    """
+    reporters = [progress_reporter(bot, chat_id, message_id) for chat_id, message_id in chats]
+    def on_progress(done, total):
+        for reporter in reporters:
+            reporter(done, total)
+
+    with FETCHING_LOCK:
+        FETCHING[str(ep.ep_id)] += 1
+    try:
+        ep.file_id = ep.get_file_id(pod.title, pod.image_file_id, on_progress)
+        with db.transaction():
+            db.update_item_in_table(ep.ep_id, "episodes", {"file_id": ep.file_id})
+            db.update_item_in_table(ep.ep_id, "episode_jobs",
+                                    {"state": UPLOADED, "file_id": ep.file_id, "updated_at": int(time.time())})
+    except (UploadError, DownloadError, CacheFull, RequestException, OSError, sqlite3.Error) as e:
+        # the chats are told first, so they aren't left waiting if the database is what failed
+        for chat_id, message_id in chats:
+            edit_notification(bot, chat_id, message_id, "<i>Couldn't upload the episode, please try again later.</i>")
+        with db.transaction():
+            db.update_item_in_table(ep.ep_id, "episode_jobs",
+                                    {"state": FAILED, "error": str(e), "updated_at": int(time.time())})
+            for chat_id, _ in chats:
+                db.remove_episode_job_chat(ep.ep_id, chat_id)
+        raise
+    finally:
+        with FETCHING_LOCK:
+            FETCHING[str(ep.ep_id)] -= 1
+
+
+def users_waiting(ep_id=None):
+    """
+    Returns whether chats are waiting for the episode to be fetched, or for any episode if ep_id is None.
+    """
+    with FETCHING_LOCK:
+        return FETCHING[str(ep_id)] > 0 if ep_id is not None else bool(+FETCHING)
+
+
+def deliver(bot, pod, ep, chat_id, message_id, tracked=True):
+    """
+    Sends the audio and replaces the notification message. If the chat is waiting in a job (tracked),
+    it stops waiting, also when it can't receive the audio, e.g. because it blocked the bot.
+    """
+    text = f"<b>{pod.title}</b>\n<i>{pod.artist}</i>\n~\n<b>{ep.title}</b>\n{ep.duration} <b>·</b> {ep.published_str}\n\nvia @undercast_bot"
+    try:
+        bot.send_audio(chat_id=chat_id,
+                       audio=ep.file_id,
+                       performer=pod.title,
+                       title=ep.title,
+                       caption=text,
+                       parse_mode='html',
+                       timeout=120)
+    except (Unauthorized, BadRequest):
+        if tracked:
+            db.remove_episode_job_chat(ep.ep_id, chat_id)
+        raise
+
+    if tracked:
+        with db.transaction():
+            db.remove_episode_job_chat(ep.ep_id, chat_id)
+            if not db.get_episode_job_chats(ep.ep_id):
+                db.update_episode_job_state(ep.ep_id, UPLOADED, DELIVERED, int(time.time()))
+
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except TelegramError:
+        pass # the notification is already gone
+
+
+def resume_pending(bot):
+    """
+    Called on startup. Finishes the jobs that weren't delivered before the bot stopped, on
+    RESUME_EXECUTOR's threads, and sweeps the episode files that no unfinished job needs from tools.EPISODE_CACHE.
+    """
+    jobs = db.get_episode_jobs([DOWNLOADING, UPLOADED])
+    tools.EPISODE_CACHE.sweep([job[0] for job in jobs if job[2] == DOWNLOADING])
+    if jobs:
+        print(f"RESUMING EPISODE JOBS: {len(jobs)} jobs.")
+        for job in jobs:
+            RESUME_EXECUTOR.submit(_resume, bot, job)
+
+
+def _resume(bot, job):
+    ep_id, pod_id, state = job[:3]
+    try:
+        chats = db.get_episode_job_chats(ep_id)
+        if not chats:
+            if state == DOWNLOADING:
+                range_downloader.remove_download(tools.episode_file_path(ep_id))
+            db.update_episode_job_state(ep_id, state, DELIVERED if state == UPLOADED else FAILED, int(time.time()))
+            return
+
+        pod_row, ep_row = db.get_podcast_and_episode(pod_id, ep_id)
+        pod = tools.convert_db_output_to_object(pod_row, "Pod")
+        ep = tools.convert_db_output_to_object(ep_row, "Episode")
+        if state == DOWNLOADING:
+            fetch(bot, pod, ep, chats)
+        for chat_id, message_id in chats:
+            try:
+                deliver(bot, pod, ep, chat_id, message_id)
+            except TelegramError as e:
+                print(f"EPISODE DELIVERY FAILED: episode {ep_id}, chat {chat_id}, {e}.")
+    except Exception as e:
+        print(f"EPISODE JOB RESUME FAILED: episode {ep_id}, {e}.")
+
+
+def progress_reporter(bot, chat_id, message_id):
+    """
+    Returns an on_progress(done, total) callback for episode downloads, which edits the
+    notification message with the percentage downloaded, at most once per PROGRESS_EDIT_INTERVAL.
+    Once the download is complete the message says the upload has started.
+    """
+    lock = Lock()
+    last_edit = {"at": 0, "text": None}
+
+    def on_progress(done, total):
+        finished = bool(total) and done >= total
+        if finished:
+            text = '<i>Uploading episode, please wait…</i>'
+        elif total:
+            text = f'<i>Downloading episode… {done * 100 // total}%</i>'
+        else:
+            text = f'<i>Downloading episode… {done // (1024 * 1024)} MB</i>'
+
+        now = time.monotonic()
+        with lock:
+            if text == last_edit["text"] or (not finished and now - last_edit["at"] < PROGRESS_EDIT_INTERVAL):
+                return
+            last_edit["at"], last_edit["text"] = now, text
+        edit_notification(bot, chat_id, message_id, text)
+
+    return on_progress
+
+
+def edit_notification(bot, chat_id, message_id, text):
+    try:
+        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='html')
+    except TelegramError:
+        pass # notifications are best effort, the job carries on
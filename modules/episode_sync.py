@@ -0,0 +1,146 @@
+"""
+episode_sync.py
+
+Incremental synchronisation of a podcast's stored episodes with its RSS feed.
+
+Fetched feed entries are matched against stored episodes by guid, falling back to the source link
+for episodes stored before guids were recorded. Only new entries are inserted and only entries whose
+fields changed are updated. Each podcast keeps a last_synced watermark, so feeds are revalidated at
+most once per SYNC_INTERVAL. The subscription poller and users opening a podcast sync through the same
+single-flight, so a podcast is never synced twice at once.
+
+Whoever triggers a sync, the new episodes it stores are passed to the on_new_episodes callback,
+so subscribers hear about them even when a user's view of the podcast found them first.
+"""
+
+import time
+
+# Local modules
+from . import tools, feed_cache
+from .database import db
+from .entities import Episode
+from .single_flight import SingleFlight
+
+SYNC_INTERVAL = 60 * 60 # seconds
+SYNCED_FIELDS = [
+        "title",
+        "subtitle",
+        "summary",
+        "published_str",
+        "published_ts",
+        "duration",
+        "link",
+        "guid",
+        "caption",
+        "shownotes"
+    ]
+POD_SYNCS = SingleFlight()
+on_new_episodes = None # set by the bot on startup, called as on_new_episodes(pod, episodes)
+
+
+def needs_sync(pod):
+    """
+    Checks the podcast's watermark. Podcasts that were never synced always need a sync.
+    """
+    if not pod.last_synced:
+        return True
+    return time.time() - int(pod.last_synced) > SYNC_INTERVAL
+
+
+def sync_podcast(pod):
+    """
+    Brings the stored episodes of a podcast up to date with its feed.
+
+    Returns a tuple of the feed information dict and a list of newly stored Episode objects.
+    The feed information is None if the feed hasn't changed since the last sync, in which case
+    nothing is parsed or written apart from the watermark.
+
+    A sync of a podcast that is already being synced waits for that sync and returns its result.
+
+    New episodes of podcasts that were synced before are passed to on_new_episodes. A podcast's
+    first sync only records its current episodes, so its whole back catalogue isn't reported as new.
+    """
+    return POD_SYNCS.do([("pod_id", str(pod.pod_id))], _sync_podcast, pod)
+
+
+def _sync_podcast(pod):
+    """
+    Stored episodes are diffed inside the write transaction, so a concurrent sync of the same
+    podcast can't have stored new episodes under the same IDs in the meantime. The feed's new
+    validators are cached in the same transaction, so a sync that fails fetches the feed in full again.
+    """
+    feed = feed_cache.fetch(pod.feed_url, store=False)
+    parsed = tools.parse_fetched_feed(feed, only_if_modified=bool(db.episodes_are_stored(pod.pod_id)))
+
+    new_episodes = []
+    was_synced = bool(pod.last_synced)
+    pod.last_synced = int(time.time())
+    with db.transaction():
+        if parsed is not None:
+            feed_info, entries = parsed
+            stored = [tools.convert_db_output_to_object(row, "Episode") for row in db.get_all_episodes(pod.pod_id)]
+            new_episodes = _store_entries(pod.pod_id, entries, stored)
+        else:
+            feed_info = None
+        feed.store()
+        db.update_item_in_table(pod.pod_id, "podcasts", {"last_synced": pod.last_synced})
+    print(f"SYNCED PODCAST: {pod.pod_id}, {len(new_episodes)} new episodes.")
+
+    if new_episodes and was_synced and on_new_episodes is not None:
+        try:
+            on_new_episodes(pod, new_episodes)
+        except Exception as e:
+            print(f"NEW EPISODES CALLBACK FAILED: podcast {pod.pod_id}, {e}.")
+
+    return feed_info, new_episodes
+
+
+def _store_entries(pod_id, entries, stored):
+    """
+    Diffs feed entries against stored episodes, inserting new ones and updating changed ones
+    with one batched statement each.
+
+    New episodes continue the index sequence of the podcast's stored episodes, so existing
+    episode IDs never change.
+    """
+    stored_by_key = dict()
+    for ep in stored:
+        for key in (ep.guid, ep.link):
+            if key:
+                stored_by_key.setdefault(key, ep)
+
+    next_index = max((_ep_index(pod_id, ep.ep_id) for ep in stored), default=-1) + 1
+    seen = set()
+    new_episodes = []
+    changed_episodes = dict()
+
+    for entry in entries:
+        fetched = Episode(entry, pod_id, next_index)
+        match = stored_by_key.get(fetched.guid) or stored_by_key.get(fetched.link)
+
+        if match is None:
+            if fetched.guid is not None and fetched.guid in seen:
+                continue
+            new_episodes.append(fetched)
+            next_index += 1
+        elif match.ep_id not in seen:
+            changed = {field: getattr(fetched, field) for field in SYNCED_FIELDS
+                       if getattr(fetched, field) != getattr(match, field)}
+            if changed:
+                # too_long is stored as text, so it's compared through the caption and show notes instead
+                changed["too_long"] = fetched.too_long
+                changed_episodes[match.ep_id] = changed
+            seen.add(match.ep_id)
+        if fetched.guid is not None:
+            seen.add(fetched.guid)
+
+    if new_episodes:
+        db.add_episodes([tools.convert_object_to_db_input(ep) for ep in new_episodes])
+    if changed_episodes:
+        db.update_items_in_table("episodes", changed_episodes)
+
+    return new_episodes
+
+
+def _ep_index(pod_id, ep_id):
+    return int(str(ep_id)[len(str(pod_id)):])
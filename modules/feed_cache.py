@@ -0,0 +1,86 @@
+"""
+feed_cache.py
+
+Conditional-GET cache for RSS feeds.
+
+The ETag and Last-Modified validators of the last successful fetch are stored in the feeds table,
+alongside a zlib-compressed copy of the feed body. Every fetch sends the validators back to the
+server, so an unchanged feed costs a 304 response instead of a full download.
+"""
+
+import zlib
+import requests
+
+# Local modules
+from . import database, http_client
+
+COMPRESSION_LEVEL = 6
+
+
+class CachedFeed:
+    """
+    The result of a feed fetch. 'modified' is False when the server answered with a 304
+    and the body was taken from the cache.
+
+    A modified feed fetched with store=False is only cached once store is called.
+    """
+    def __init__(self, feed_url, body, content_type, modified, validators=None):
+        self.feed_url = feed_url
+        self.body = body
+        self.content_type = content_type
+        self.modified = modified
+        self.validators = validators # (etag, last_modified) not stored yet
+
+
+    def store(self):
+        if self.validators is None:
+            return
+        etag, last_modified = self.validators
+        database.db.store_cached_feed(self.feed_url, etag, last_modified, self.content_type,
+                                      zlib.compress(self.body, COMPRESSION_LEVEL))
+        self.validators = None
+
+
+def fetch(feed_url, store=True):
+    """
+    Fetches a feed, revalidating the cached copy if there is one. Returns a CachedFeed.
+
+    If the request fails and a cached copy exists, the stale copy is returned as unmodified
+    rather than failing the whole podcast view.
+
+    With store=False a modified feed isn't cached until the caller calls its store method,
+    e.g. once the feed's episodes are stored, so that a failure in between doesn't leave the new
+    validators behind and get the next fetch a 304 for a feed that was never processed.
+    """
+    cached = database.db.get_cached_feed(feed_url)
+    headers = dict()
+    if cached:
+        etag, last_modified, _, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = http_client.get(feed_url, headers=headers)
+        response.raise_for_status()
+    except requests.RequestException:
+        if cached:
+            print(f"FEED FETCH FAILED: using cached copy of {feed_url}.")
+            return _from_cache(feed_url, cached)
+        raise
+
+    if response.status_code == 304 and cached:
+        print(f"FEED NOT MODIFIED: {feed_url}.")
+        return _from_cache(feed_url, cached)
+
+    feed = CachedFeed(feed_url, response.content, response.headers.get("Content-Type"), modified=True,
+                      validators=(response.headers.get("ETag"), response.headers.get("Last-Modified")))
+    if store:
+        feed.store()
+    return feed
+
+
+def _from_cache(feed_url, cached):
+    _, _, content_type, body = cached
+    return CachedFeed(feed_url, zlib.decompress(body), content_type, modified=False)
@@ -39,6 +39,14 @@ def not_imp_button(update, context):
                      text='Feature is not yet implemented.')
     
     
+def expired_list_button(update, context):
+    """
+    Catches navigation buttons of lists sent before list pages were encoded in the buttons.
+    """
+    query = update.callback_query
+    query.answer("This list is out of date, please open it again.")
+
+
 def unknown(update, context):
     """
     Catches unknown commands.
@@ -27,21 +27,23 @@ handlers = {
         "unsubscribe_callback_handler": CallbackQueryHandler(search_logic.unsubscribe_callback, pattern='^[0-9]+unsubscribe[0-9]+$'),
 
         # Episode list navigation
+        "search_episodes_callback_handler": CallbackQueryHandler(search_logic.search_episodes_callback, pattern='^[0-9]+search_episodes$'),
         "view_episodes_callback_handler": CallbackQueryHandler(search_logic.view_episodes_callback, pattern='^episodes[0-9]+$'),
         "back_to_podcast_callback_handler": CallbackQueryHandler(search_logic.back_to_podcast_callback, pattern='^[0-9]+return[0-9]+$'),
-        "episodes_navigation_callback_handler": CallbackQueryHandler(search_logic.episodes_navigation_callback, pattern='^eps_navigation'),
+        "episodes_navigation_callback_handler": CallbackQueryHandler(search_logic.episodes_navigation_callback, pattern='^eps_[0-9]+_[0-9]+$'),
 
         # Display selected episode
-        "episode_selection_callback_handler": CallbackQueryHandler(search_logic.episode_selection_callback, pattern='^[0-9]+_[0-9]+$'),
+        "episode_selection_callback_handler": CallbackQueryHandler(search_logic.episode_selection_callback, pattern='^[0-9]+_[0-9]+(_[0-9]+)?$'),
         "return_to_episode_list_callback_handler": CallbackQueryHandler(search_logic.return_to_episode_list_callback, pattern='^[0-9]+return_to_episode_list[0-9]+$'),
         "download_episode_callback_handler": CallbackQueryHandler(search_logic.download_episode_callback, pattern='^[0-9]+download[0-9]+$'),
         "view_shownotes_callback_handler": CallbackQueryHandler(search_logic.view_shownotes_callback, pattern='^[0-9]+shownotes[0-9]+$'),
         "hide_shownotes_callback_handler": CallbackQueryHandler(search_logic.hide_shownotes_callback, pattern='^hide_shownotes$'),
 
         # Subscription list navigation
-        "subscriptions_navigation_callback_handler": CallbackQueryHandler(search_logic.subscriptions_navigation_callback, pattern='^subs_navigation'),
+        "subscriptions_navigation_callback_handler": CallbackQueryHandler(search_logic.subscriptions_navigation_callback, pattern='^subs_[0-9]+$'),
 
         # Generic handlers
         "not_imp_handler": CallbackQueryHandler(generic_logic.not_imp_button, pattern='^n_i$'),
+        "expired_list_handler": CallbackQueryHandler(generic_logic.expired_list_button, pattern='^(eps|subs)_navigation'),
         "unknown_handler": MessageHandler(Filters.command, generic_logic.unknown)
 }
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""
+html_sanitizer.py
+
+Single-pass conversion of feed HTML into the subset that Telegram accepts with parse_mode='html'.
+
+The text is split once with a compiled tokenizer pattern that finds tags, comments and
+declarations, and everything between them is text. Supported tags are kept without their attributes,
+except for the href of links. Headings become bold text, and list items, paragraphs and
+line breaks become plain-text line breaks. All other tags are dropped, but their text is
+kept, except inside script and style. Entities are decoded and the text is escaped again,
+so the output has no entities that Telegram doesn't know. Tags left open or closed in the
+wrong order are closed properly, so the output is always well-formed.
+
+Feeds repeat the same few tags throughout their show notes, so what each tag is replaced with is
+worked out once and cached by the tag's text. Only the tags that open or close a Telegram tag
+are then looked at one by one, to keep track of which tags are open.
+"""
+
+import re
+from html import escape, unescape
+
+# Telegram tag: the tag it's written as
+INLINE_TAGS = {
+        "b": "b",
+        "strong": "b",
+        "i": "i",
+        "em": "i",
+        "u": "u",
+        "ins": "u",
+        "s": "s",
+        "strike": "s",
+        "del": "s",
+        "code": "code",
+        "pre": "pre",
+        "a": "a"
+    }
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+BLOCK_TAGS = {"p", "div", "ul", "ol", "blockquote", "section", "article", "table", "tr"}
+SKIPPED_TAGS = {"script", "style"}
+LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+MAX_CACHED_TAGS = 10000
+
+# what to do with each tag that isn't just dropped: a Telegram tag, or one of these actions
+LINE_BREAK, LIST_ITEM, BLOCK, HEADING, SKIP = range(5)
+TAG_ACTIONS = dict(INLINE_TAGS, br=LINE_BREAK, li=LIST_ITEM)
+TAG_ACTIONS.update((tag, BLOCK) for tag in BLOCK_TAGS)
+TAG_ACTIONS.update((tag, HEADING) for tag in HEADING_TAGS)
+TAG_ACTIONS.update((tag, SKIP) for tag in SKIPPED_TAGS)
+
+TOKEN = re.compile(r'(<(?:/?[a-zA-Z][^>]*>|!--.*?(?:-->|$)|[!?][^>]*>))', re.S)
+TAG = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>')
+HREF = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+EXCESS_NEWLINES = re.compile(r'\n[ \t\n]*\n')
+TELEGRAM_TAG = re.compile(r'<(/?)(b|i|u|s|code|pre|a)[\s>]')
+
+
+class TagReplacements(dict):
+    """
+    Maps the text of a tag, comment or declaration to what it's replaced with. That's a string,
+    or for tags that depend on the tags open around them, a tuple of (is_end_tag, action, text):
+    the text a Telegram tag is written as, or the tag's name for script and style.
+    """
+    def __missing__(self, token):
+        if len(self) >= MAX_CACHED_TAGS:
+            self.clear()
+        self[token] = replacement = tag_replacement(token)
+        return replacement
+
+
+def tag_replacement(token):
+    match = TAG.match(token)
+    if match is None:
+        return "" # a comment or declaration
+    is_end_tag, tag, attributes = match.groups()
+    tag = tag.lower()
+    action = TAG_ACTIONS.get(tag)
+
+    if action is None:
+        return ""
+    elif action == LINE_BREAK:
+        return "\n"
+    elif action == LIST_ITEM:
+        return "" if is_end_tag else "\n- "
+    elif action == BLOCK:
+        return "\n\n"
+    elif action == HEADING:
+        return (bool(is_end_tag), HEADING, "")
+    elif action == SKIP:
+        return (bool(is_end_tag), SKIP, tag)
+    elif is_end_tag:
+        return (True, action, f"</{action}>")
+    elif action == "a":
+        href = link_target(attributes)
+        # links without a usable target are kept as plain text
+        return (False, "a", f'<a href="{escape(href)}">') if href else ""
+    elif attributes.rstrip().endswith("/"):
+        return ""
+    return (False, action, f"<{action}>")
+
+
+TAG_REPLACEMENTS = TagReplacements()
+
+
+def sanitize(text):
+    """
+    Returns text as HTML that Telegram accepts.
+    """
+    if not text:
+        return ""
+    if "<" not in text:
+        return tidy_whitespace(escape_text(text))
+
+    pieces = TOKEN.split(text) # text, token, text, ..., text
+    texts = pieces[::2]
+    replacements = list(map(TAG_REPLACEMENTS.__getitem__, pieces[1::2]))
+    open_tags = [] # Telegram tags written so far and not yet closed
+    skip_until = -1 # the end tag of the last script or style element
+
+    for i, replacement in enumerate(replacements):
+        if replacement.__class__ is str or i <= skip_until:
+            continue
+        is_end_tag, action, written = replacement
+
+        if action.__class__ is str:
+            if not is_end_tag:
+                # nested links aren't allowed
+                if action == "a" and "a" in open_tags:
+                    written = ""
+                else:
+                    open_tags.append(action)
+            elif open_tags and open_tags[-1] == action:
+                open_tags.pop()
+            else:
+                output = []
+                close_tag(action, open_tags, output)
+                written = "".join(output)
+        elif action == HEADING:
+            if is_end_tag:
+                output = []
+                close_tag("b", open_tags, output)
+                written = "".join(output) + "\n\n"
+            else:
+                open_tags.append("b")
+                written = "\n\n<b>"
+        elif not is_end_tag: # script or style
+            end_tag = (True, SKIP, written)
+            skip_until = next((j for j in range(i + 1, len(replacements)) if replacements[j] == end_tag),
+                              len(replacements))
+            replacements[i:skip_until + 1] = [""] * len(replacements[i:skip_until + 1])
+            texts[i + 1:skip_until + 1] = [""] * len(texts[i + 1:skip_until + 1])
+            continue
+        else:
+            written = ""
+        replacements[i] = written
+
+    # the pieces of text are escaped in one go, joined with NUL, which no entity can contain
+    if "\0" in text:
+        pieces[::2] = [escape_text(text) for text in texts]
+    else:
+        pieces[::2] = escape_text("\0".join(texts)).split("\0")
+    pieces[1::2] = replacements
+    while open_tags:
+        pieces.append(f"</{open_tags.pop()}>")
+    return tidy_whitespace(''.join(pieces))
+
+
+def close_open_tags(text):
+    """
+    Returns sanitized text that was cut short, e.g. by captions.truncate, with the tags left open closed.
+    """
+    open_tags = []
+    for is_end_tag, tag in TELEGRAM_TAG.findall(text):
+        if is_end_tag:
+            close_tag(tag, open_tags, [])
+        else:
+            open_tags.append(tag)
+    return text + "".join(f"</{tag}>" for tag in reversed(open_tags))
+
+
+def tidy_whitespace(text):
+    """
+    Collapses blank lines, and the spaces before them, into one empty line and strips the text.
+    """
+    text = EXCESS_NEWLINES.sub("\n\n", text)
+    if " \n\n" in text or "\t\n\n" in text:
+        text = "\n\n".join([part.rstrip(" \t") for part in text.split("\n\n")])
+    return text.strip()
+
+
+def escape_text(text):
+    if "&" in text:
+        text = unescape(text)
+    if "&" in text or "<" in text or ">" in text:
+        text = escape(text, quote=False)
+    return text.replace("\xa0", " ")
+
+
+def link_target(attributes):
+    """
+    Returns the decoded href of an <a> tag's attributes, if it's a link Telegram can open.
+    """
+    match = HREF.search(attributes)
+    if match is None:
+        return None
+    href = unescape(next(value for value in match.groups() if value is not None)).strip()
+    return href if href.lower().startswith(LINK_SCHEMES) else None
+
+
+def close_tag(tag, open_tags, output):
+    """
+    Closes the innermost open 'tag', along with any tags opened inside it that weren't
+    closed yet. End tags without a matching open tag are dropped.
+    """
+    if tag not in open_tags:
+        return
+    while open_tags:
+        innermost = open_tags.pop()
+        output.append(f"</{innermost}>")
+        if innermost == tag:
+            break
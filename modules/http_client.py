@@ -0,0 +1,65 @@
+"""
+http_client.py
+
+A single pooled HTTP session shared by every outbound request the bot makes.
+
+Connections are kept alive and pooled per host, every request gets connect and read timeouts,
+and idempotent requests are retried with exponential backoff on connection errors and on
+throttling or server error responses.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+USER_AGENT = "UndercastBot (+https://t.me/undercast_bot)"
+POOL_CONNECTIONS = 16 # number of hosts to keep connection pools for
+POOL_MAXSIZE = 16 # connections kept alive per host
+CONNECT_TIMEOUT = 5 # seconds
+READ_TIMEOUT = 30 # seconds between bytes received, not for the whole response
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5 # retries wait 0.5s, 1s, 2s...
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                   max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+    Creates a session with pooled, retrying adapters mounted for both http and https.
+    """
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=retry)
+
+    new_session = requests.Session()
+    new_session.headers["User-Agent"] = USER_AGENT
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    return new_session
+
+
+def configure(**kwargs):
+    """
+    Replaces the shared session with one built from the given create_session arguments.
+    """
+    global session
+    old_session = session
+    session = create_session(**kwargs)
+    old_session.close()
+
+
+def get(url, **kwargs):
+    """
+    Sends a GET request through the shared session. Timeouts default to
+    (CONNECT_TIMEOUT, READ_TIMEOUT) unless given explicitly.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session.get(url, **kwargs)
+
+
+session = create_session()
@@ -7,8 +7,8 @@ Inline keyboard generators that get called by logic functions.
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-# Local imports
-from .tools import create_paginated_list
+EPISODES_PER_PAGE = 6
+SUBSCRIPTIONS_PER_PAGE = 7
 
 
 def pod_list_keyboard(pods: list):
@@ -19,7 +19,7 @@ def pod_list_keyboard(pods: list):
     for pod in pods:
         label = f"{pod.title} | {pod.artist}"
         keyboard.append([
-            InlineKeyboardButton(label, callback_data=pod.pod_id)
+            InlineKeyboardButton(label, callback_data=str(pod.pod_id))
             ])
     
     return InlineKeyboardMarkup(keyboard)
@@ -38,78 +38,70 @@ def pod_view_keyboard(pod_id, user_id, is_subscribed):
             [InlineKeyboardButton("Subscribe", callback_data=f"{pod_id}subscribe{user_id}")]
         ]
     keyboard.append([InlineKeyboardButton("Episodes", callback_data=f"episodes{pod_id}")])
+    keyboard.append([InlineKeyboardButton("Search episodes", callback_data=f"{pod_id}search_episodes")])
     
     return InlineKeyboardMarkup(keyboard)
     
 
-def episodes_keyboard(eps, pod_id, user_id):
+def episodes_keyboard(eps, pod_id, user_id, page_index, n_pages):
     """
-    Returns a list of prepared keyboards for each page of episode list view.
+    Generates the keyboard for one page of the episode list view.
+
+    Navigation buttons carry the podcast and the target page in their callback data,
+    e.g. eps_<pod_id>_<page_index>, so no per-chat state is needed to render a page.
     """
-    max_eps_per_page = 6
-    idx_list = create_paginated_list(max_eps_per_page, len(eps))
-    keyboards= []
-    first_page = InlineKeyboardButton("<< First", callback_data="eps_navigation_first")
-    last_page = InlineKeyboardButton("Last >>", callback_data="eps_navigation_last")
-    prev_page = InlineKeyboardButton("< Prev", callback_data="eps_navigation_prev")
-    next_page = InlineKeyboardButton("Next >", callback_data="eps_navigation_next")
     back_to_pod = InlineKeyboardButton("Back to podcast", callback_data=f"{pod_id}return{user_id}")
-    
-    start = 0
-    for page_index in range(len(idx_list)):
-        keyboard = []
-        end = idx_list[page_index]
-        for ep_index in range(start, end):
-            ep = eps[ep_index]
-            keyboard.append([InlineKeyboardButton(f'{ep.title} | {ep.duration}',
-                            callback_data=f'{pod_id}_{ep.ep_id}')])
-        # add prev, next, and back to podcast buttons to k
-        if (page_index == 0) and (page_index != len(idx_list) - 1):
-            keyboard.append([next_page, last_page])
-        elif (page_index == len(idx_list) - 1) and (page_index != 0):
-            keyboard.append([first_page, prev_page])
-        elif page_index != 0:
-            keyboard.append([first_page, prev_page, next_page, last_page])
-        keyboard.append([back_to_pod])
-        start = end
-            
-        keyboards.append(InlineKeyboardMarkup(keyboard))
-
-    return keyboards
-
-
-def subscriptions_keyboard(pods):
+
+    keyboard = []
+    for ep in eps:
+        keyboard.append([InlineKeyboardButton(f'{ep.title} | {ep.duration}',
+                        callback_data=f'{pod_id}_{ep.ep_id}_{page_index}')])
+    # add prev, next, and back to podcast buttons to keyboard
+    navigation = navigation_row(f"eps_{pod_id}_", page_index, n_pages)
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([back_to_pod])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def subscriptions_keyboard(pods, page_index, n_pages):
     """
-    Returns a list of prepared keyboards for each page of subscription list view.
+    Generates the keyboard for one page of the subscription list view.
+    Navigation buttons carry the target page, e.g. subs_<page_index>.
     """
-    max_pods_per_page = 7
-    idx_list = create_paginated_list(max_pods_per_page, len(pods))
-    keyboards= []
-    first_page = InlineKeyboardButton("<< First", callback_data="subs_navigation_first")
-    last_page = InlineKeyboardButton("Last >>", callback_data="subs_navigation_last")
-    prev_page = InlineKeyboardButton("< Prev", callback_data="subs_navigation_prev")
-    next_page = InlineKeyboardButton("Next >", callback_data="subs_navigation_next")
-    
-    start = 0
-    for page_index in range(len(idx_list)):
-        keyboard = []
-        end = idx_list[page_index]
-        for pod_index in range(start, end):
-            pod = pods[pod_index]
-            keyboard.append([InlineKeyboardButton(f"{pod.title} | {pod.artist}",
-                            callback_data=pod.pod_id)])
-        # add navigation buttons to keyboard
-        if (page_index == 0) and (page_index != len(idx_list) - 1):
-            keyboard.append([next_page, last_page])
-        elif (page_index == len(idx_list) - 1) and (page_index != 0):
-            keyboard.append([first_page, prev_page])
-        elif page_index != 0:
-            keyboard.append([first_page, prev_page, next_page, last_page])
-        start = end
-            
-        keyboards.append(InlineKeyboardMarkup(keyboard))
-
-    return keyboards
+    keyboard = []
+    for pod in pods:
+        keyboard.append([InlineKeyboardButton(f"{pod.title} | {pod.artist}",
+                        callback_data=str(pod.pod_id))])
+    # add navigation buttons to keyboard
+    navigation = navigation_row("subs_", page_index, n_pages)
+    if navigation:
+        keyboard.append(navigation)
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def navigation_row(callback_prefix, page_index, n_pages):
+    """
+    Generates First/Prev/Next/Last buttons pointing at absolute page indices.
+    """
+    first_page = InlineKeyboardButton("<< First", callback_data=f"{callback_prefix}0")
+    last_page = InlineKeyboardButton("Last >>", callback_data=f"{callback_prefix}{n_pages - 1}")
+    prev_page = InlineKeyboardButton("< Prev", callback_data=f"{callback_prefix}{page_index - 1}")
+    next_page = InlineKeyboardButton("Next >", callback_data=f"{callback_prefix}{page_index + 1}")
+
+    if (page_index == 0) and (page_index != n_pages - 1):
+        return [next_page, last_page]
+    elif (page_index == n_pages - 1) and (page_index != 0):
+        return [first_page, prev_page]
+    elif page_index != 0:
+        return [first_page, prev_page, next_page, last_page]
+    return []
+
+
+def count_pages(n_items, items_per_page):
+    return max((n_items + items_per_page - 1) // items_per_page, 1)
 
 
 def episode_view_keyboard(ep_id, pod_id, page_index, too_long):
@@ -0,0 +1,302 @@
+"""
+notifications.py
+
+Fan-out delivery of new episode alerts to subscribers.
+
+New episodes reported by the subscription poller are collected per user for DIGEST_WINDOW seconds,
+so a user subscribed to several podcasts that update together gets one digest message. Digests are
+sent from a priority queue by a single sender thread, throttled by token buckets for the global and
+per-chat limits. GLOBAL_RATE is kept below Telegram's ~30 messages per second, which leaves headroom
+for interactive replies. Messages rejected with RetryAfter pause the sender for the requested time and
+are requeued; other transient errors are retried with backoff up to MAX_ATTEMPTS.
+"""
+
+import heapq
+import html
+import itertools
+import time
+from threading import Condition, Lock, Thread
+
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TelegramError
+
+# Local modules
+from .database import db
+
+GLOBAL_RATE = 25 # messages per second
+GLOBAL_BURST = 25
+PER_CHAT_RATE = 1 # messages per second
+PER_CHAT_BURST = 3
+MAX_CHAT_BUCKETS = 10000
+DIGEST_WINDOW = 60 # seconds
+MAX_EPISODES_PER_PODCAST = 5
+MAX_MESSAGE_LENGTH = 4096
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2 # seconds, doubled after every attempt
+ERROR_BACKOFF = 1 # seconds the sender waits after an unexpected error
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TokenBucket:
+    """
+    Allows 'rate' events per second on average, and bursts of up to 'capacity' events.
+    """
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def wait_time(self, now):
+        """
+        Returns how long to wait until a token is available, 0 if one is available now.
+        """
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Message:
+    def __init__(self, chat_id, text, priority=PRIORITY_NORMAL):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.attempts = 0
+
+
+class Notifier:
+    """
+    Rate limits, pauses and digest windows are measured with 'clock', time.monotonic by default.
+    """
+    def __init__(self, bot, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE, digest_window=DIGEST_WINDOW,
+                 clock=time.monotonic):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.digest_window = digest_window
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, GLOBAL_BURST, clock())
+        self.chat_buckets = dict()
+        self.paused_until = 0
+
+        self.condition = Condition(Lock())
+        self.ready = [] # heap of (priority, seq, Message)
+        self.delayed = [] # heap of (not_before, seq, Message)
+        self.seq = itertools.count()
+
+        self.digests = dict() # user_id: list of (pod, episodes)
+        self.digests_due = None
+        self.digests_lock = Lock()
+
+        self.metrics = {
+            "queued": 0,
+            "sent": 0,
+            "retried": 0,
+            "rate_limited": 0,
+            "failed": 0,
+            "digests": 0
+        }
+        self.running = False
+        self.thread = None
+
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, name="notifier", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+    def notify_new_episodes(self, pod, episodes):
+        """
+        Adds new episodes of a podcast to the pending digest of each of its subscribers.
+        Meant to be used as episode_sync's on_new_episodes callback.
+        """
+        subscribers = db.get_subscribers(pod.pod_id)
+        with self.digests_lock:
+            for user_id in subscribers:
+                self.digests.setdefault(user_id, []).append((pod, episodes))
+            if subscribers and self.digests_due is None:
+                self.digests_due = self.clock() + self.digest_window
+        with self.condition:
+            self.condition.notify()
+        print(f"QUEUED NEW EPISODE ALERTS: podcast {pod.pod_id}, {len(subscribers)} subscribers.")
+
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL):
+        self.count("queued")
+        self.enqueue(Message(chat_id, text, priority))
+
+
+    def enqueue(self, message, not_before=0):
+        with self.condition:
+            if not_before > self.clock():
+                heapq.heappush(self.delayed, (not_before, next(self.seq), message))
+            else:
+                heapq.heappush(self.ready, (message.priority, next(self.seq), message))
+            self.condition.notify()
+
+
+    def count(self, metric):
+        with self.condition:
+            self.metrics[metric] += 1
+
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.metrics)
+            stats["ready"] = len(self.ready)
+            stats["delayed"] = len(self.delayed)
+        with self.digests_lock:
+            stats["pending_digests"] = len(self.digests)
+        return stats
+
+
+    def flush_digests(self, force=False):
+        """
+        Turns pending digests into queued messages once the digest window has passed.
+        """
+        with self.digests_lock:
+            if not self.digests or (not force and self.clock() < self.digests_due):
+                return
+            digests, self.digests, self.digests_due = self.digests, dict(), None
+
+        for user_id, updates in digests.items():
+            for text in render_digest(updates):
+                self.send(user_id, text)
+            self.count("digests")
+
+
+    def run(self):
+        """
+        The sender loop. Unexpected errors are logged and the loop carries on, so one bad
+        digest or network failure doesn't stop all later notifications.
+        """
+        while self.running:
+            try:
+                self.flush_digests()
+                message = self.next_message()
+                if message is not None:
+                    self.deliver(message)
+            except Exception as e:
+                print(f"NOTIFIER ERROR: {e}.")
+                time.sleep(ERROR_BACKOFF)
+
+
+    def next_message(self):
+        """
+        Returns the most urgent message that may be sent now without breaking a rate limit.
+        If there is none, waits until one might be, or until new work arrives, and returns None.
+        """
+        with self.condition:
+            now = self.clock()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, seq, message = heapq.heappop(self.delayed)
+                heapq.heappush(self.ready, (message.priority, seq, message))
+
+            waits = []
+            if self.paused_until > now:
+                waits.append(self.paused_until - now)
+            elif self.ready:
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait == 0:
+                    _, seq, message = heapq.heappop(self.ready)
+                    chat_bucket = self.chat_bucket(message.chat_id, now)
+                    chat_wait = chat_bucket.wait_time(now)
+                    if chat_wait == 0:
+                        self.global_bucket.consume(now)
+                        chat_bucket.consume(now)
+                        return message
+                    # the chat is over its limit, let other chats' messages go first
+                    heapq.heappush(self.delayed, (now + chat_wait, seq, message))
+                    return None
+                waits.append(global_wait)
+            if self.delayed:
+                waits.append(self.delayed[0][0] - now)
+            if self.digests_due is not None:
+                waits.append(self.digests_due - now)
+
+            if self.running:
+                self.condition.wait(max(min(waits), 0) if waits else None)
+            return None
+
+
+    def chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                # full buckets behave exactly like new ones, so they can be dropped
+                for key, old_bucket in list(self.chat_buckets.items()):
+                    old_bucket.refill(now)
+                    if old_bucket.tokens >= old_bucket.capacity:
+                        del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, PER_CHAT_BURST, now)
+        return bucket
+
+
+    def deliver(self, message):
+        message.attempts += 1
+        try:
+            self.bot.send_message(chat_id=message.chat_id,
+                                  text=message.text,
+                                  parse_mode='html',
+                                  disable_web_page_preview=True)
+            self.count("sent")
+        except RetryAfter as e:
+            self.count("rate_limited")
+            with self.condition:
+                self.paused_until = max(self.paused_until, self.clock() + e.retry_after)
+            print(f"NOTIFIER RATE LIMITED: pausing for {e.retry_after}s.")
+            self.enqueue(message)
+        except (Unauthorized, BadRequest) as e:
+            # the user blocked the bot, or the message can never be sent
+            self.count("failed")
+            print(f"NOTIFICATION DROPPED: chat {message.chat_id}, {e}.")
+        except TelegramError as e:
+            if message.attempts >= MAX_ATTEMPTS:
+                self.count("failed")
+                print(f"NOTIFICATION FAILED: chat {message.chat_id}, {e}.")
+                return
+            self.count("retried")
+            delay = RETRY_BACKOFF * 2 ** (message.attempts - 1)
+            self.enqueue(message, not_before=self.clock() + delay)
+
+
+def render_digest(updates):
+    """
+    Renders a list of (pod, episodes) tuples into one or more message texts,
+    each within Telegram's message length limit.
+    """
+    blocks = []
+    for pod, episodes in updates:
+        lines = [f"<b>{html.escape(pod.title)}</b>"]
+        for ep in episodes[:MAX_EPISODES_PER_PODCAST]:
+            lines.append(f"- {html.escape(ep.title)} | {ep.duration}")
+        if len(episodes) > MAX_EPISODES_PER_PODCAST:
+            lines.append(f"<i>and {len(episodes) - MAX_EPISODES_PER_PODCAST} more</i>")
+        blocks.append('\n'.join(lines))
+
+    header = "<b>New episodes</b>\n\n"
+    texts = [header]
+    for block in blocks:
+        if len(texts[-1]) + len(block) + 2 > MAX_MESSAGE_LENGTH:
+            texts.append(header)
+        texts[-1] += block + "\n\n"
+
+    return [text.rstrip() for text in texts]
@@ -0,0 +1,222 @@
+"""
+persistence.py
+
+SQLite-backed persistence for python-telegram-bot, replacing PicklePersistence.
+
+Each chat's and user's data is stored as its own pickled row, so saving after an update only writes
+the rows whose data actually changed. Rows are loaded lazily the first time a chat or user is seen,
+and entries that have been idle for IDLE_TIMEOUT are dropped from memory (they are reloaded on their
+next update), so memory use follows the number of active chats rather than all chats ever seen.
+
+Eviction runs as a JobQueue job every EVICTION_INTERVAL, see schedule_eviction. Jobs run one at a time
+on the JobQueue thread, followed by the dispatcher's update_persistence, so entries are never dropped
+while the dispatcher iterates over them. That update_persistence reads every entry in memory to save it,
+so reads that are followed by saving unchanged data don't count as accesses, or no entry would ever
+become idle.
+"""
+
+import json
+import pickle
+import sqlite3
+import time
+from collections import defaultdict
+from hashlib import sha1
+from threading import RLock
+
+from telegram.ext import BasePersistence
+
+IDLE_TIMEOUT = 30 * 60 # seconds
+EVICTION_INTERVAL = 5 * 60 # seconds
+BUSY_TIMEOUT = 10 # seconds
+
+
+class LazyData(defaultdict):
+    """
+    A defaultdict that loads missing entries with 'loader' instead of creating empty ones,
+    and records when each entry was last accessed.
+    """
+    def __init__(self, loader):
+        super().__init__(dict)
+        self.loader = loader
+        self.last_access = dict()
+        self.previous_access = dict()
+
+
+    def __missing__(self, key):
+        value = self.loader(key)
+        self[key] = value
+        return value
+
+
+    def __getitem__(self, key):
+        self.previous_access[key] = self.last_access.get(key)
+        self.last_access[key] = time.monotonic()
+        return super().__getitem__(key)
+
+
+    def undo_access(self, key):
+        """
+        Restores the access time from before the latest access, for a read that wasn't activity.
+        """
+        previous = self.previous_access.get(key)
+        if previous is not None:
+            self.last_access[key] = previous
+
+
+    def evict_idle(self, idle_timeout):
+        """
+        Drops entries that weren't accessed for idle_timeout seconds. Returns the evicted keys.
+        """
+        cutoff = time.monotonic() - idle_timeout
+        idle = [key for key, accessed in self.last_access.items() if accessed < cutoff]
+        for key in idle:
+            self.pop(key, None)
+            del self.last_access[key]
+            self.previous_access.pop(key, None)
+        return idle
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, filename="bot.db", store_user_data=True, store_chat_data=True, store_bot_data=True,
+                 idle_timeout=IDLE_TIMEOUT):
+        super().__init__(store_user_data=store_user_data,
+                         store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.connection = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.lock = RLock()
+        self.idle_timeout = idle_timeout
+        self.digests = {"chat": dict(), "user": dict(), "bot": None} # id: sha1 of the last stored pickle
+        self.chat_data = None
+        self.user_data = None
+        self.bot_data = None
+        self.conversations = dict()
+
+        with self.lock:
+            self.connection.executescript("""
+                    CREATE TABLE IF NOT EXISTS chat_data
+                        (chat_id INTEGER PRIMARY KEY, data BLOB);
+                    CREATE TABLE IF NOT EXISTS user_data
+                        (user_id INTEGER PRIMARY KEY, data BLOB);
+                    CREATE TABLE IF NOT EXISTS bot_data
+                        (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB);
+                    CREATE TABLE IF NOT EXISTS conversations
+                        (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));""")
+            self.connection.commit()
+
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self.chat_data = LazyData(lambda chat_id: self.load("chat", chat_id))
+        return self.chat_data
+
+
+    def get_user_data(self):
+        if self.user_data is None:
+            self.user_data = LazyData(lambda user_id: self.load("user", user_id))
+        return self.user_data
+
+
+    def get_bot_data(self):
+        if self.bot_data is None:
+            with self.lock:
+                row = self.connection.execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+            self.bot_data = pickle.loads(row[0]) if row else dict()
+            self.digests["bot"] = sha1(row[0] if row else pickle.dumps(self.bot_data)).digest()
+        return self.bot_data
+
+
+    def get_conversations(self, name):
+        if name not in self.conversations:
+            with self.lock:
+                rows = self.connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+                self.conversations[name] = {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+        return self.conversations[name].copy()
+
+
+    def update_conversation(self, name, key, new_state):
+        conversations = self.conversations.setdefault(name, dict())
+        if conversations.get(key) == new_state:
+            return
+        conversations[key] = new_state
+        with self.lock:
+            if new_state is None:
+                self.connection.execute("DELETE FROM conversations WHERE name = ? AND key = ?",
+                                        (name, json.dumps(key)))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                                        (name, json.dumps(key), pickle.dumps(new_state)))
+            self.connection.commit()
+
+
+    def update_chat_data(self, chat_id, data):
+        self.store("chat", chat_id, data)
+
+
+    def update_user_data(self, user_id, data):
+        self.store("user", user_id, data)
+
+
+    def update_bot_data(self, data):
+        """
+        Called after every update. Writes the bot data only if it changed since it was last stored.
+        """
+        blob = pickle.dumps(data)
+        digest = sha1(blob).digest()
+        with self.lock:
+            if digest == self.digests["bot"]:
+                return
+            self.connection.execute("INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (blob,))
+            self.connection.commit()
+            self.digests["bot"] = digest
+
+
+    def flush(self):
+        with self.lock:
+            self.connection.commit()
+
+
+    def load(self, kind, item_id):
+        with self.lock:
+            row = self.connection.execute(f"SELECT data FROM {kind}_data WHERE {kind}_id = ?", (item_id,)).fetchone()
+        if row is None:
+            return dict()
+        self.digests[kind][item_id] = sha1(row[0]).digest()
+        return pickle.loads(row[0])
+
+
+    def store(self, kind, item_id, data):
+        """
+        Writes an entry only if it differs from what was last loaded or stored. Unchanged entries
+        were only read to be saved, so that read isn't counted as an access.
+        """
+        blob = pickle.dumps(data)
+        digest = sha1(blob).digest()
+        with self.lock:
+            stored_digest = self.digests[kind].get(item_id)
+            if digest == stored_digest or (stored_digest is None and not data):
+                lazy_data = self.chat_data if kind == "chat" else self.user_data
+                if lazy_data is not None:
+                    lazy_data.undo_access(item_id)
+                return
+            self.connection.execute(f"INSERT OR REPLACE INTO {kind}_data VALUES (?, ?)", (item_id, blob))
+            self.connection.commit()
+            self.digests[kind][item_id] = digest
+
+
+    def schedule_eviction(self, job_queue, interval=EVICTION_INTERVAL):
+        job_queue.run_repeating(self.evict_idle, interval=interval, first=interval, name="evict-idle-data")
+
+
+    def evict_idle(self, context=None):
+        """
+        Drops idle chats and users from memory. Their data is already stored, since every update
+        is written as soon as it happens. Run it as a job, see schedule_eviction.
+        """
+        with self.lock:
+            for kind, data in (("chat", self.chat_data), ("user", self.user_data)):
+                if data is None:
+                    continue
+                for item_id in data.evict_idle(self.idle_timeout):
+                    self.digests[kind].pop(item_id, None)
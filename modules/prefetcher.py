@@ -0,0 +1,194 @@
+"""
+prefetcher.py
+
+Background acquisition of file IDs for the episodes that subscribers are most likely to download.
+
+Every PREFETCH_INTERVAL, or as soon as the subscription poller finds new episodes, recent episodes
+without a file ID are ranked by their podcast's subscriber count, halved for every RECENCY_HALF_LIFE
+since they were published, and the best MAX_PREFETCHES are downloaded and uploaded like a user's
+download would be, so the first user to ask for one gets it instantly.
+
+Prefetching only uses what users leave over: it works on a pool of PREFETCH_WORKERS threads, kept for
+as long as the prefetcher runs so they keep their database connections, downloads at most
+PREFETCH_BANDWIDTH bytes per second between them and doesn't start an episode while a user is waiting
+for one (see episode_jobs). An episode is only prefetched if the episode files, the new one included,
+fit in PREFETCH_DISK_SHARE of the episode cache, so the rest of it is always left for users' downloads.
+A user asking for an episode that is being prefetched joins that download, which then runs at full speed.
+"""
+
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+from requests import RequestException
+
+# Local modules
+from . import tools, episode_jobs
+from .database import db
+from .disk_cache import CacheFull
+from .range_downloader import DownloadError
+from .upload_jobs import UploadError
+
+PREFETCH_INTERVAL = 15 * 60 # seconds
+PREFETCH_WORKERS = 1
+PREFETCH_BANDWIDTH = 2 * 1024 * 1024 # bytes per second, shared by all workers
+PREFETCH_DISK_SHARE = 0.5 # of tools.EPISODE_CACHE's quota
+MIN_SUBSCRIBERS = 2
+MAX_EPISODE_AGE = 3 * 24 * 60 * 60 # seconds
+RECENCY_HALF_LIFE = 24 * 60 * 60 # seconds
+MAX_CANDIDATES = 100
+MAX_PREFETCHES = 10 # per run
+FAILURE_COOLDOWN = 6 * 60 * 60 # seconds before an episode that failed is tried again
+
+
+class BandwidthLimit:
+    """
+    Spaces out reads so that, across all threads, they average at most 'rate' bytes per second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = Lock()
+        self.available_at = time.monotonic()
+
+
+    def wait(self, n_bytes):
+        """
+        Called after reading n_bytes, sleeps until the budget allows reading more.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now) + n_bytes / self.rate
+            delay = self.available_at - now
+        time.sleep(delay)
+
+
+class Prefetcher:
+    def __init__(self, workers=PREFETCH_WORKERS, bandwidth=PREFETCH_BANDWIDTH):
+        self.workers = workers
+        self.bandwidth = BandwidthLimit(bandwidth)
+        self.failed = dict() # ep_id: time of the last failure
+        self.stopped = Event()
+        self.woken = Event()
+        self.thread = None
+        self.executor = None
+
+
+    def start(self):
+        """
+        Starts prefetching on a daemon thread.
+        """
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name="prefetcher", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        self.woken.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+    def wake(self):
+        """
+        Starts a prefetch run now, e.g. when new episodes were found.
+        """
+        self.woken.set()
+
+
+    def run(self):
+        while True:
+            self.woken.wait(PREFETCH_INTERVAL)
+            self.woken.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.prefetch()
+            except Exception as e:
+                print(f"PREFETCH FAILED: {e}.")
+
+
+    def prefetch(self):
+        """
+        Fetches the file IDs of the best ranked episodes. Returns the number of episodes fetched.
+        """
+        started = time.monotonic()
+        candidates = self.rank(time.time())
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prefetch")
+        fetched = sum(self.executor.map(self.fetch, candidates))
+
+        print(f"PREFETCH: {len(candidates)} candidates, {fetched} fetched, {time.monotonic() - started:.1f}s.")
+        return fetched
+
+
+    def rank(self, now):
+        """
+        Returns a list of (Pod, Episode) to prefetch, best first.
+        """
+        rows = db.get_prefetch_candidates(int(now - MAX_EPISODE_AGE), MIN_SUBSCRIBERS, MAX_CANDIDATES)
+        self.failed = {ep_id: failed_at for ep_id, failed_at in self.failed.items()
+                       if now - failed_at < FAILURE_COOLDOWN}
+        scored = []
+        for ep_row, subscribers in rows:
+            ep = tools.convert_db_output_to_object(ep_row, "Episode")
+            if now - self.failed.get(ep.ep_id, 0) < FAILURE_COOLDOWN:
+                continue
+            score = subscribers * 0.5 ** ((now - ep.published_ts) / RECENCY_HALF_LIFE)
+            scored.append((score, ep))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        episodes = [ep for _, ep in scored[:MAX_PREFETCHES]]
+
+        pods = {row[0]: tools.convert_db_output_to_object(row, "Pod")
+                for row in db.get_podcasts(list({ep.pod_id for ep in episodes}))}
+        return [(pods[ep.pod_id], ep) for ep in episodes if ep.pod_id in pods]
+
+
+    def fetch(self, candidate):
+        """
+        Fetches one episode's file ID, unless a user is waiting or the budgets are used up.
+        Returns True if the file ID was fetched.
+        """
+        pod, ep = candidate
+        if self.stopped.is_set() or not self.idle():
+            return False
+
+        try:
+            disk_limit = tools.EPISODE_CACHE.quota * PREFETCH_DISK_SHARE
+            ep.file_id = ep.get_file_id(pod.title, pod.image_file_id, self.throttle(ep.ep_id), disk_limit)
+            db.update_item_in_table(ep.ep_id, "episodes", {"file_id": ep.file_id})
+        except (UploadError, DownloadError, CacheFull, RequestException, OSError, sqlite3.Error) as e:
+            self.failed[ep.ep_id] = time.time()
+            print(f"PREFETCH FAILED: episode {ep.ep_id}, {e}.")
+            return False
+
+        print(f"PREFETCHED: episode {ep.ep_id} of podcast {pod.pod_id}.")
+        return True
+
+
+    def idle(self):
+        if episode_jobs.users_waiting():
+            return False
+        stats = tools.EPISODE_CACHE.stats()
+        return stats["bytes"] < stats["quota"] * PREFETCH_DISK_SHARE
+
+
+    def throttle(self, ep_id):
+        """
+        Returns the on_progress callback for a prefetch, which holds the download to the bandwidth
+        budget until a user asks for the same episode.
+        """
+        last = {"done": None} # resumed downloads start counting at the bytes downloaded before
+
+        def on_progress(done, total):
+            n_bytes = done - last["done"] if last["done"] is not None else 0
+            last["done"] = max(done, last["done"] or 0)
+            if n_bytes > 0 and not episode_jobs.users_waiting(ep_id):
+                self.bandwidth.wait(n_bytes)
+
+        return on_progress
+
+
+prefetcher = Prefetcher()
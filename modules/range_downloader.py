@@ -0,0 +1,274 @@
+"""
+range_downloader.py
+
+Segmented downloads of large files over parallel HTTP Range requests.
+
+A probe request for the first byte tells whether the server supports ranges and how large the
+file is. If it does, the file is preallocated and SEGMENTS byte ranges are fetched at the same time,
+each written at its own offset. Servers without Range support, files of unknown size and files
+smaller than MIN_SEGMENTED_SIZE are fetched as a single stream. Redirects (e.g. from analytics
+prefixes) are followed once by the probe, and the segments are requested from the final URL.
+
+Segmented downloads record how far each segment got in a <path>.parts file as they go. If the
+download is interrupted, even by the process being killed, the next download to the same path
+continues each segment where it stopped, provided the server still reports the same file, as told
+by a strong ETag or Last-Modified. If a server answers a segment request with the whole file, the
+download starts over as a single stream.
+The .parts file is kept after the download completes, so downloading the same file again only
+costs the probe, until remove_download deletes both files.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Local modules
+from . import http_client
+
+SEGMENTS = 4
+MIN_SEGMENTED_SIZE = 8 * 1024 * 1024 # bytes, smaller files aren't worth the extra requests
+CHUNK_SIZE = 1024 * 1024
+SAVE_BYTES = 8 * 1024 * 1024 # written between saves of a segmented download's state, at most
+SAVE_INTERVAL = 2 # seconds between saves, at most
+CONTENT_RANGE = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RangeIgnored(DownloadError):
+    """
+    Raised when a segment request is answered with the whole file, e.g. because the file changed.
+    """
+
+
+class Progress:
+    """
+    Counts downloaded bytes across segments and reports them to on_progress(done, total).
+    total is None when the server didn't send the file size.
+    """
+    def __init__(self, total, on_progress, done=0):
+        self.total = total
+        self.done = done
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+
+
+    def add(self, n_bytes):
+        with self.lock:
+            self.done += n_bytes
+            done = self.done
+        if self.on_progress is not None:
+            self.on_progress(done, self.total)
+
+
+class Parts:
+    """
+    The resumable state of a segmented download: the file it's for, and a list of
+    [start, end, bytes written] for each segment, saved to <path>.parts every SAVE_BYTES or
+    SAVE_INTERVAL, whichever comes first, and when a segment stops. The saved state can lag
+    behind the file, which only means a resumed download fetches a few bytes again.
+    """
+    def __init__(self, path, url, total, validator, segments):
+        self.path = parts_path(path)
+        self.url = url
+        self.total = total
+        self.validator = validator
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.unsaved = 0 # bytes
+        self.saved_at = time.monotonic()
+
+
+    @classmethod
+    def load(cls, path, url, total, validator):
+        """
+        Returns the saved state of an interrupted download of the same file to path, or None.
+        Without a validator there's no telling if the file changed, so nothing is resumed.
+        """
+        try:
+            with open(parts_path(path)) as f:
+                saved = json.load(f)
+            if (validator and saved["url"] == url and saved["total"] == total
+                    and saved["validator"] == validator and os.path.getsize(path) == total):
+                return cls(path, url, total, validator, saved["segments"])
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+
+    def advance(self, index, n_bytes):
+        with self.lock:
+            self.segments[index][2] += n_bytes
+            self.unsaved += n_bytes
+            if self.unsaved >= SAVE_BYTES or time.monotonic() - self.saved_at >= SAVE_INTERVAL:
+                self.save()
+
+
+    def flush(self):
+        """
+        Saves the state if anything was written since the last save.
+        """
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+
+    def save(self):
+        state = {"url": self.url, "total": self.total, "validator": self.validator, "segments": self.segments}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path) # never leaves a half-written state file
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+
+    def done(self):
+        return sum(written for _, _, written in self.segments)
+
+
+def range_validator(headers):
+    """
+    Returns what identifies this version of the file, for If-Range and for resuming: a strong ETag,
+    or else Last-Modified. Weak ETags (W/"...") aren't allowed in If-Range and don't promise the same bytes.
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def parts_path(path):
+    return str(path) + ".parts"
+
+
+def download(url, path, on_progress=None, segments=SEGMENTS, reserve=None):
+    """
+    Downloads url to path, continuing an interrupted download to the same path if there is one.
+    reserve(n_bytes) is called with the size of the file before it's written, if it's known,
+    so that the caller can make room for it or refuse it by raising. Returns the size of the file.
+    """
+    probe = http_client.get(url, headers={"Range": "bytes=0-0"}, stream=True)
+    with probe:
+        probe.raise_for_status()
+        match = CONTENT_RANGE.match(probe.headers.get("Content-Range", ""))
+        if probe.status_code != 206 or match is None:
+            # the server ignored the Range header and is sending the whole file
+            return _download_stream(probe, url, path, on_progress, reserve, "no Range support")
+        total = int(match.group(1))
+        final_url = probe.url
+        validator = range_validator(probe.headers)
+
+    if reserve is not None:
+        reserve(total)
+
+    parts = Parts.load(path, url, total, validator)
+    if parts is not None:
+        print(f"RESUMING DOWNLOAD: {url}, {parts.done()} of {total} bytes already downloaded.")
+    else:
+        if total < MIN_SEGMENTED_SIZE or segments < 2:
+            ranges = [[0, total - 1, 0]]
+        else:
+            segment_size = -(-total // segments) # rounded up
+            ranges = [[start, min(start + segment_size, total) - 1, 0] for start in range(0, total, segment_size)]
+        parts = Parts(path, url, total, validator, ranges)
+        with open(path, 'wb') as f:
+            f.truncate(total)
+        parts.save()
+
+    progress = Progress(total, on_progress, parts.done())
+    pending = [index for index, (start, end, written) in enumerate(parts.segments) if written < end - start + 1]
+    if pending:
+        cancelled = threading.Event()
+        try:
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="range-download") as executor:
+                futures = [executor.submit(_download_range, final_url, path, parts, index, progress, cancelled)
+                           for index in pending]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    cancelled.set() # the other segments stop at their next chunk
+                    raise
+        except RangeIgnored as e:
+            print(f"RANGE REQUEST IGNORED: {e}, downloading in one stream.")
+            with http_client.get(final_url, stream=True) as response:
+                response.raise_for_status()
+                return _download_stream(response, url, path, on_progress, reserve, "Range requests ignored")
+
+    print(f"DOWNLOADED: {url}, {total} bytes in {len(parts.segments)} segments.")
+    return total
+
+
+def remove_parts(path):
+    if os.path.exists(parts_path(path)):
+        os.remove(parts_path(path))
+
+
+def remove_download(path):
+    """
+    Removes a downloaded file along with its download state.
+    """
+    remove_parts(path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _download_range(url, path, parts, index, progress, cancelled):
+    start, end, written = parts.segments[index]
+    headers = {"Range": f"bytes={start + written}-{end}"}
+    if parts.validator:
+        # if the file changed since the probe, the server sends all of it instead of mixing versions
+        headers["If-Range"] = parts.validator
+
+    with http_client.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeIgnored(f"{url} changed during the download, or stopped honouring Range requests")
+        try:
+            with open(path, 'r+b') as f:
+                f.seek(start + written)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if cancelled.is_set():
+                        return
+                    f.write(chunk)
+                    f.flush() # the data must be in the file before the state says it is
+                    parts.advance(index, len(chunk))
+                    progress.add(len(chunk))
+        finally:
+            parts.flush() # keeps what this segment got, however it stopped
+
+    start, end, written = parts.segments[index]
+    if written != end - start + 1:
+        raise DownloadError(f"{url}: expected {end - start + 1} bytes from offset {start}, got {written}")
+
+
+def _download_stream(response, url, path, on_progress, reserve, reason):
+    """
+    Writes the whole file from a response that isn't a byte range.
+    """
+    remove_parts(path)
+    length = response.headers.get("Content-Length")
+    if length and reserve is not None:
+        reserve(int(length))
+    progress = Progress(int(length) if length else None, on_progress)
+    with open(path, 'wb') as f:
+        size = _write_stream(response, f, progress)
+    if progress.total is None and on_progress is not None:
+        on_progress(size, size) # the size is only known now
+    print(f"DOWNLOADED: {url}, {size} bytes in one stream ({reason}).")
+    return size
+
+
+def _write_stream(response, f, progress):
+    written = 0
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        f.write(chunk)
+        written += len(chunk)
+        progress.add(len(chunk))
+    return written
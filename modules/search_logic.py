@@ -8,34 +8,142 @@ Interfacing between Pod/Episode objects and the database:
 - tools.convert_object_to_db_input(object)
 """
 
-import re, os
+import re, html
+from requests import RequestException
+from telegram import ForceReply
+from telegram.error import BadRequest
 from telegram.ext.dispatcher import run_async
 
 # Local imports
-from . import tools, inline_keyboards
-from .database import db
-from .entities import Pod, Episode
+from . import tools, inline_keyboards, episode_sync, episode_jobs
+from .database import db, PHOTO
 
+# the BadRequest messages Telegram sends when it can't use a photo given by URL or file ID, lowercased
+PHOTO_ERRORS = ("wrong file identifier/http url specified",
+                "failed to get http url content",
+                "wrong type of the web page content",
+                "photo_invalid_dimensions",
+                "image_process_failed")
+
+# the "Search episodes" prompt links the podcast's title here, which tells replies to it which podcast they're for
+EPISODE_SEARCH_LINK = "https://podcasts.apple.com/podcast/id{}"
+EPISODE_SEARCH_POD_ID = re.compile(r'https://podcasts\.apple\.com/podcast/id(\d+)$')
+
+
+@run_async
 def search(update, context):
     """
     Any plaintext message is considered a search query.
+
+    Podcasts already in the database are looked up in the local full-text index and listed
+    straight away, then the iTunes results are merged into the list once they arrive.
+    If iTunes is slow or failing, the local results still get through.
+
+    Replies to the prompt of a podcast's "Search episodes" button search that podcast's episodes instead.
     """
-    search_term = '+'.join(update.message.text.split(' '))
-    json = tools.get_search_json(search_term)
-    n = json['resultCount']
-    if n == 0:
+    pod_id = episode_search_pod_id(update.message, context.bot)
+    if pod_id is not None:
+        search_episodes(update, context, pod_id)
+        return
+
+    search_term = update.message.text
+    match_query = tools.fts_query(search_term)
+    local_rows = db.search_podcasts(match_query, tools.MAX_LOCAL_SEARCH_RESULTS) if match_query else []
+    local_pods = [tools.convert_db_output_to_object(row, "Pod") for row in local_rows]
+
+    message = None
+    if local_pods:
+        keyboard = inline_keyboards.pod_list_keyboard(local_pods)
+        message = update.message.reply_text(search_results_text(len(local_pods)), reply_markup=keyboard)
+
+    try:
+        json = tools.get_search_json('+'.join(search_term.split(' ')))
+        itunes_pods = tools.json_to_pods(json['results']) # a list of Pod objects
+    except (RequestException, ValueError, KeyError) as e:
+        print(f"ITUNES SEARCH FAILED: {search_term}, {e}.")
+        itunes_pods = []
+
+    # Store the podcast data for future reference.
+    if itunes_pods:
+        db.upsert_podcasts([tools.convert_object_to_db_input(pod) for pod in itunes_pods])
+
+    pods = merge_search_results(local_pods, itunes_pods)
+
+    if not pods:
         update.message.reply_text("Couldn't find anything, try a different search term.")
-    else:
-        text = f"Found {n} result" + ("s:" if n > 1 else ":")
-        pods = tools.json_to_pods(json['results']) # a list of Pod objects
+    elif message is None:
+        keyboard = inline_keyboards.pod_list_keyboard(pods)
+        update.message.reply_text(search_results_text(len(pods)), reply_markup=keyboard)
+    elif len(pods) > len(local_pods):
         keyboard = inline_keyboards.pod_list_keyboard(pods)
-        update.message.reply_text(text, reply_markup=keyboard)
+        message.edit_text(search_results_text(len(pods)), reply_markup=keyboard)
+
+
+def merge_search_results(local_pods, itunes_pods):
+    """
+    Lists the local results first, then the iTunes results that weren't found locally.
+    Stored podcasts have integer IDs and iTunes ones string IDs, so they're compared as strings.
+    """
+    local_ids = {str(pod.pod_id) for pod in local_pods}
+    pods = local_pods + [pod for pod in itunes_pods if str(pod.pod_id) not in local_ids]
+    return pods[:tools.MAX_SEARCH_RESULTS]
+
+
+def search_results_text(n):
+    return f"Found {n} result" + ("s:" if n > 1 else ":")
+
+
+def search_episodes(update, context, pod_id):
+    """
+    Searches the titles and descriptions of a podcast's stored episodes, and sends the matches
+    as an episode list under the podcast's artwork.
+    """
+    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
+    match_query = tools.fts_query(update.message.text)
+    episodes_raw = db.search_episodes(pod_id, match_query, inline_keyboards.EPISODES_PER_PAGE) if match_query else []
+    if not episodes_raw:
+        update.message.reply_text(
+            f"No episodes of {pod.title} match that. Send it without replying to search for podcasts instead."
+        )
+        return
+
+    episodes = [tools.convert_db_output_to_object(ep, "Episode") for ep in episodes_raw] # a list of Episode objects
+    keyboard = inline_keyboards.episodes_keyboard(episodes, pod.pod_id, update.effective_user.id, 0, 1)
+    send_artwork(context.bot, update.effective_chat.id, pod, pod.generate_description(), keyboard)
+
+
+def search_episodes_callback(update, context):
+    """
+    Called by the "Search episodes" button of a podcast view.
+    Asks for the search terms with a forced reply, so the answer is tied to the podcast by the
+    message it replies to, rather than by state kept for the chat.
+    """
+    query = update.callback_query
+    query.answer()
+
+    pod_id = query.data.split("search_episodes")[0]
+    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
+    link = EPISODE_SEARCH_LINK.format(pod.pod_id)
+
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text=f'What should I look for in <a href="{link}"><b>{html.escape(pod.title)}</b></a> episodes?',
+                             parse_mode='html',
+                             disable_web_page_preview=True,
+                             reply_markup=ForceReply())
+
 
-        # Store the podcast data for future reference.
-        for pod in pods:
-            if not db.get_podcast(pod.pod_id):
-                pod_data = tools.convert_object_to_db_input(pod)
-                db.add_podcast(pod_data)
+def episode_search_pod_id(message, bot):
+    """
+    Returns the pod_id of the "Search episodes" prompt that the message replies to, or None.
+    """
+    prompt = message.reply_to_message
+    if prompt is None or prompt.from_user is None or prompt.from_user.id != bot.id:
+        return None
+    for entity in prompt.entities:
+        match = EPISODE_SEARCH_POD_ID.match(entity.url or "")
+        if match:
+            return match.group(1)
+    return None
 
 
 def subscriptions(update, context):
@@ -46,32 +154,35 @@ def subscriptions(update, context):
     bot = context.bot
     user_id = update.effective_user.id
 
-    subs = db.get_all_subscriptions(user_id) # either None or a list of pod_id tuples (pod_id,)
-    if not subs:
+    if not db.count_subscriptions(user_id):
         update.message.reply_text(
             """You aren't subscribed to any podcasts. Use the "Subscribe" button when viewing a podcast to add it to this list."""
         )
     else:
-        pods = []
-        for pod_id in subs:
-            pod_id = pod_id[0]
-            pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
-            pods.append(pod)
-    
-        keyboard_list = inline_keyboards.subscriptions_keyboard(pods)
+        keyboard = subscriptions_page_keyboard(user_id, 0)
+        update.message.reply_text("Your subscriptions:", reply_markup=keyboard)
 
-        page_index = 0
-        context.chat_data["subscriptions_keyboard_list"] = keyboard_list
-        context.chat_data["subscriptions_keyboard_list_page_index"] = page_index
-        keyboard = keyboard_list[page_index]
 
-        update.message.reply_text("Your subscriptions:", reply_markup=keyboard)
+def subscriptions_page_keyboard(user_id, page_index):
+    """
+    Fetches a single page of a user's subscriptions from the database and renders its keyboard.
+    """
+    per_page = inline_keyboards.SUBSCRIPTIONS_PER_PAGE
+    n_pages = inline_keyboards.count_pages(db.count_subscriptions(user_id), per_page)
+    page_index = min(max(page_index, 0), n_pages - 1)
+
+    subs = db.get_subscribed_podcasts(user_id, per_page, page_index * per_page) # a list of podcast rows
+    pods = [tools.convert_db_output_to_object(pod, "Pod") for pod in subs]
+
+    return inline_keyboards.subscriptions_keyboard(pods, page_index, n_pages)
 
 
 def podcast_selection_callback(update, context):
     """
     Called when a podcast is selected from any list (search results, subscriptions, etc.).
 
+    Stored episodes are brought up to date with the feed at most once per episode_sync.SYNC_INTERVAL.
+
     Issues:
     - Takes too long to download and parse the RSS feed for podcasts not already stored, ~2-3 seconds.
     """
@@ -81,38 +192,58 @@ def podcast_selection_callback(update, context):
 
     pod_id = query.data
     pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod") # this is a Pod object
+    columns_to_update = dict()
 
-    if not db.episodes_are_stored(pod.pod_id):
-        feed_info, episodes_raw = tools.parse_feed(pod.feed_url)
-        episodes = [Episode(ep, pod.pod_id, index) for index, ep in enumerate(episodes_raw)]
-        for ep in episodes:
-            ep_data = tools.convert_object_to_db_input(ep)
-            db.add_episode(ep_data)
-        pod.subtitle = tools.get_pod_subtitle_from_feed(feed_info)
-        image = tools.download_artwork(pod.image_url, pod.pod_id)
-    else:
-        image = pod.image_file_id
+    if episode_sync.needs_sync(pod):
+        feed_info, _ = episode_sync.sync_podcast(pod)
+        if feed_info is not None:
+            subtitle = tools.get_pod_subtitle_from_feed(feed_info)
+            if subtitle != pod.subtitle:
+                pod.subtitle = subtitle
+                columns_to_update["subtitle"] = subtitle
 
     description = pod.generate_description()
     user_id = update.effective_user.id
     keyboard = inline_keyboards.pod_view_keyboard(pod.pod_id, user_id, db.is_subscribed_to(user_id, pod.pod_id))
-    
-    m = bot.send_photo(chat_id=update.effective_chat.id,
-                   photo=open(image, 'rb') if type(image) is not str else image,
-                   caption=description,
-                   parse_mode='html',
-                   reply_markup=keyboard)
-    
-    # store artwork file ID and subtitle in db
-    if type(image) is not str:
-        pod.image_file_id = str(m.photo[0].file_id)
-        columns_to_update = {
-            "image_file_id": pod.image_file_id,
-            "subtitle": pod.subtitle
-            }
+    send_artwork(bot, update.effective_chat.id, pod, description, keyboard)
+
+    if columns_to_update:
         db.update_item_in_table(pod.pod_id, "podcasts", columns_to_update)
 
-        os.remove(image)
+
+def send_artwork(bot, chat_id, pod, caption, keyboard):
+    """
+    Sends the podcast's artwork with the caption and keyboard, and returns the message.
+
+    Artwork already sent for any podcast is reused by file ID, other artwork is sent by URL.
+    If Telegram can't use the file ID, the URL is tried next, and if it can't fetch the URL either,
+    the artwork is uploaded from memory. A new file ID is stored for the podcast and its artwork URL.
+    """
+    cached_id = pod.image_file_id or tools.get_cached_artwork_id(pod.image_url)
+    sources = ([cached_id] if cached_id else []) + [pod.image_url, None] # None: upload from memory
+
+    for source in sources:
+        try:
+            m = bot.send_photo(chat_id=chat_id,
+                               photo=source if source is not None else tools.fetch_artwork(pod.image_url),
+                               caption=caption,
+                               parse_mode='html',
+                               reply_markup=keyboard)
+            break
+        except BadRequest as e:
+            if source is None or not any(error in e.message.lower() for error in PHOTO_ERRORS):
+                raise # e.g. the caption, which would fail the same way again
+
+    if source == cached_id:
+        image = cached_id
+    else:
+        photo = m.photo[-1] # the largest size
+        image = photo.file_id
+        db.cache_file_id(PHOTO, pod.image_url, image, photo.file_size)
+    if image != pod.image_file_id:
+        pod.image_file_id = image
+        db.update_item_in_table(pod.pod_id, "podcasts", {"image_file_id": image})
+    return m
 
 
 def subscribe_callback(update, context):
@@ -162,19 +293,23 @@ def view_episodes_callback(update, context):
 
     pod_id = re.search(r'[0-9]+', query.data).group(0)
     user_id = update.effective_user.id
-    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
 
-    episodes_raw = db.get_all_episodes(pod.pod_id)
-    episodes = [tools.convert_db_output_to_object(ep, "Episode") for ep in episodes_raw] # a list of Episode objects
-    
-    keyboard_list = inline_keyboards.episodes_keyboard(episodes, pod.pod_id, user_id)
-
-    page_index = 0
-    context.chat_data["episodes_keyboard_list"] = keyboard_list
-    context.chat_data["episodes_keyboard_list_page_index"] = page_index
-    keyboard = keyboard_list[page_index]
+    keyboard = episodes_page_keyboard(pod_id, user_id, 0)
     
     query.edit_message_reply_markup(keyboard)
+
+
+def episodes_page_keyboard(pod_id, user_id, page_index):
+    """
+    Fetches a single page of a podcast's episodes from the database and renders its keyboard.
+    """
+    n_pages = inline_keyboards.count_pages(db.count_episodes(pod_id), inline_keyboards.EPISODES_PER_PAGE)
+    page_index = min(max(page_index, 0), n_pages - 1)
+
+    episodes_raw = db.get_episodes_page(pod_id, inline_keyboards.EPISODES_PER_PAGE,
+                                        page_index * inline_keyboards.EPISODES_PER_PAGE)
+    episodes = [tools.convert_db_output_to_object(ep, "Episode") for ep in episodes_raw] # a list of Episode objects
+    return inline_keyboards.episodes_keyboard(episodes, pod_id, user_id, page_index, n_pages)
     
     
 def back_to_podcast_callback(update, context):
@@ -270,25 +405,18 @@ def episode_selection_callback(update, context):
     query = update.callback_query
     query.answer()
     
-    pod_id, ep_id = query.data.split("_")
-    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
-    episode = tools.convert_db_output_to_object(db.get_episode(ep_id), "Episode")
-
-    ep_had_shownotes = episode.shownotes != ""
+    pod_id, ep_id, *page_index = query.data.split("_") # page_index is missing from older buttons
+    page_index = int(page_index[0]) if page_index else 0
+    pod_row, ep_row = db.get_podcast_and_episode(pod_id, ep_id)
+    pod = tools.convert_db_output_to_object(pod_row, "Pod")
+    episode = tools.convert_db_output_to_object(ep_row, "Episode")
 
-    page_index = context.chat_data['episodes_keyboard_list_page_index']
-    description = f"<b>{pod.title}</b>\n{pod.artist}\n~\n{episode.is_chosen()}"
+    description = f"<b>{pod.title}</b>\n{pod.artist}\n~\n{episode.caption}"
     keyboard = inline_keyboards.episode_view_keyboard(ep_id, pod_id, page_index, episode.too_long)
     
     query.edit_message_caption(caption=description,
                                parse_mode='html',
                                reply_markup=keyboard)
-
-    if not ep_had_shownotes:
-        columns_to_update = {
-            "shownotes": episode.shownotes
-        }
-        db.update_item_in_table(episode.ep_id, "episodes", columns_to_update)
     
 
 def view_shownotes_callback(update, context):
@@ -303,8 +431,9 @@ def view_shownotes_callback(update, context):
     query.answer()
     
     pod_id, ep_id = query.data.split("shownotes")
-    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
-    episode = tools.convert_db_output_to_object(db.get_episode(ep_id), "Episode")
+    pod_row, ep_row = db.get_podcast_and_episode(pod_id, ep_id)
+    pod = tools.convert_db_output_to_object(pod_row, "Pod")
+    episode = tools.convert_db_output_to_object(ep_row, "Episode")
     
     text = f"<b>{pod.title}</b>\n<i>{pod.artist}</i>\n~\n<b>{episode.title}</b>\n\n{episode.shownotes}"
     keyboard = inline_keyboards.hide_shownotes_keyboard()
@@ -340,7 +469,7 @@ def return_to_episode_list_callback(update, context):
     pod_id, page_index = query.data.split("return_to_episode_list")
     pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
     text = pod.generate_description()
-    keyboard = context.chat_data["episodes_keyboard_list"][int(page_index)]
+    keyboard = episodes_page_keyboard(pod_id, update.effective_user.id, int(page_index))
     
     query.edit_message_caption(caption=text,
                               parse_mode='html',
@@ -349,54 +478,26 @@ def return_to_episode_list_callback(update, context):
 
 def episodes_navigation_callback(update, context):
     """
-    Changes the current page of the episodes list based on the query:
-    Next, Prev, First, or Last page.
+    Changes the current page of the episodes list to the page in the query: eps_<pod_id>_<page_index>.
     """
     query = update.callback_query
     query.answer()
 
-    request = query.data.split("_")[-1]
-    keyboard_list = context.chat_data["episodes_keyboard_list"]
-    page_index = context.chat_data["episodes_keyboard_list_page_index"]
-
-    if request == "next":
-        page_index += 1
-    elif request == "prev":
-        page_index -= 1
-    elif request == "first":
-        page_index = 0
-    else:
-        page_index = len(keyboard_list) - 1
-
-    context.chat_data["episodes_keyboard_list_page_index"] = page_index
-    keyboard = keyboard_list[page_index]
+    _, pod_id, page_index = query.data.split("_")
+    keyboard = episodes_page_keyboard(pod_id, update.effective_user.id, int(page_index))
     
     query.edit_message_reply_markup(keyboard)
 
 
 def subscriptions_navigation_callback(update, context):
     """
-    Changes the current page of the subscriptions list based on the query:
-    Next, Prev, First, or Last page.
+    Changes the current page of the subscriptions list to the page in the query: subs_<page_index>.
     """
     query = update.callback_query
     query.answer()
 
-    request = query.data.split("_")[-1]
-    keyboard_list = context.chat_data["subscriptions_keyboard_list"]
-    page_index = context.chat_data["subscriptions_keyboard_list_page_index"]
-
-    if request == "next":
-        page_index += 1
-    elif request == "prev":
-        page_index -= 1
-    elif request == "first":
-        page_index = 0
-    else:
-        page_index = len(keyboard_list) - 1
-
-    context.chat_data["subscriptions_keyboard_list_page_index"] = page_index
-    keyboard = keyboard_list[page_index]
+    page_index = query.data.split("_")[-1]
+    keyboard = subscriptions_page_keyboard(update.effective_user.id, int(page_index))
     
     query.edit_message_reply_markup(keyboard)
     
@@ -416,24 +517,8 @@ def download_episode_callback(update, context):
                                         parse_mode='html')
     
     pod_id, ep_id = query.data.split("download")
-    pod = tools.convert_db_output_to_object(db.get_podcast(pod_id), "Pod")
-    ep = tools.convert_db_output_to_object(db.get_episode(ep_id), "Episode")
-
-    if not ep.file_id:
-        ep.file_id = ep.get_file_id(pod.title, pod.image_file_id)
-        columns_to_update = {
-            "file_id": ep.file_id
-        }
-        db.update_item_in_table(ep.ep_id, "episodes", columns_to_update)
-    
-    text = f"<b>{pod.title}</b>\n<i>{pod.artist}</i>\n~\n<b>{ep.title}</b>\n{ep.duration} <b>·</b> {ep.published_str}\n\nvia @undercast_bot"
-    bot.send_audio(chat_id=update.effective_chat.id,
-                    audio=ep.file_id,
-                    performer=pod.title,
-                    title=ep.title,
-                    caption=text,
-                    parse_mode='html',
-                    timeout=120)
-            
-    bot.delete_message(chat_id=update.effective_chat.id,
-                       message_id=notification_msg.message_id)
\ No newline at end of file
+    pod_row, ep_row = db.get_podcast_and_episode(pod_id, ep_id)
+    pod = tools.convert_db_output_to_object(pod_row, "Pod")
+    ep = tools.convert_db_output_to_object(ep_row, "Episode")
+
+    episode_jobs.request_episode(bot, update.effective_chat.id, notification_msg.message_id, pod, ep)
@@ -0,0 +1,67 @@
+"""
+single_flight.py
+
+Duplicate call suppression: while a call for a key is in flight, further calls for the same key
+wait for its result instead of repeating the work.
+"""
+
+from threading import Event, Lock
+
+
+class Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    A call can be registered under several keys (e.g. an episode ID and its source link), and
+    a later call joins it if any of its own keys is already in flight.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = dict()
+
+
+    def do(self, keys, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) unless a call for any of the keys is in flight, in which case
+        that call's result is returned, or its exception re-raised, once it finishes.
+        """
+        keys = [key for key in keys if key is not None]
+        with self.lock:
+            call = next((self.calls[key] for key in keys if key in self.calls), None)
+            if call is not None:
+                is_leader = False
+            else:
+                call = Call()
+                for key in keys:
+                    self.calls[key] = call
+                is_leader = True
+
+        if not is_leader:
+            print(f"JOINED IN-FLIGHT CALL: {keys}.")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                for key in keys:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+            call.done.set()
+
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
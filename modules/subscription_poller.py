@@ -0,0 +1,111 @@
+"""
+subscription_poller.py
+
+Background refresh of the feeds of all podcasts that have subscribers.
+
+Every POLL_INTERVAL (with random jitter, so restarts don't align polls with other bots or feed hosts),
+each subscribed podcast is synced once through episode_sync, however many subscribers it has.
+Feeds are fetched on a bounded thread pool that lasts as long as the poller, so its threads keep
+their database connections between polls, and at most PER_HOST_LIMIT feeds are fetched from
+the same host at a time. Newly found episodes are reported by episode_sync, see its on_new_episodes.
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Event, Lock, Thread
+from urllib.parse import urlsplit
+
+# Local modules
+from . import tools, episode_sync
+from .database import db
+
+POLL_INTERVAL = 30 * 60 # seconds
+POLL_JITTER = 0.2 # fraction of POLL_INTERVAL
+POLL_WORKERS = 8
+PER_HOST_LIMIT = 2
+
+
+class SubscriptionPoller:
+    def __init__(self, workers=POLL_WORKERS, per_host_limit=PER_HOST_LIMIT):
+        self.workers = workers
+        self.per_host_limit = per_host_limit
+        self.host_slots = dict()
+        self.host_slots_lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.executor = None
+
+
+    def start(self):
+        """
+        Starts polling on a daemon thread.
+        """
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name="subscription-poller", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+    def run(self):
+        while not self.stopped.wait(self.next_delay()):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"SUBSCRIPTION POLL FAILED: {e}.")
+
+
+    def next_delay(self):
+        return POLL_INTERVAL * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+
+    def poll(self):
+        """
+        Syncs every subscribed podcast once. Returns a dict of pod_id: list of new Episode objects.
+        """
+        started = time.monotonic()
+        pods = [tools.convert_db_output_to_object(row, "Pod")
+                for row in db.get_podcasts(db.get_subscribed_pod_ids())]
+        random.shuffle(pods) # spread each host's feeds over the whole poll
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="feed-poll")
+        results = list(self.executor.map(self.refresh, pods))
+
+        new_episodes = {pod.pod_id: episodes for pod, episodes in zip(pods, results) if episodes}
+        print(f"SUBSCRIPTION POLL: {len(pods)} podcasts, {len(new_episodes)} with new episodes, "
+              f"{time.monotonic() - started:.1f}s.")
+        return new_episodes
+
+
+    def refresh(self, pod):
+        """
+        Syncs one podcast and returns its new episodes. Podcasts that were never synced only
+        record their current episodes, so their whole back catalogue isn't counted as new.
+        """
+        was_synced = bool(pod.last_synced)
+        try:
+            with self.slot_for(pod.feed_url):
+                _, episodes = episode_sync.sync_podcast(pod)
+        except Exception as e:
+            print(f"FEED REFRESH FAILED: podcast {pod.pod_id}, {e}.")
+            return []
+
+        return episodes if was_synced else []
+
+
+    def slot_for(self, url):
+        host = urlsplit(url).hostname or ""
+        with self.host_slots_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = BoundedSemaphore(self.per_host_limit)
+            return self.host_slots[host]
+
+
+poller = SubscriptionPoller()
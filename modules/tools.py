@@ -4,27 +4,60 @@ tools.py
 Helper functions for various operations and computations required by bot routies.
 """
 
-import requests
 import re
 import feedparser
 from pathlib import Path
 import os
 from hashlib import sha256
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from math import fabs
-import urllib.request
-import shutil
-import time
 import uuid
+from io import BytesIO
+from urllib.parse import quote_plus, urlsplit, parse_qsl, urlencode
 
 # Local modules
-from .entities import Pod, Episode
-from .database import POD_COLUMNS, EP_COLUMNS
+from .database import POD_COLUMNS, EP_COLUMNS, AUDIO, PHOTO, db
+from . import entities, feed_cache, http_client, upload_jobs, html_sanitizer, range_downloader
+from .cache import TTLCache
+from .disk_cache import DiskCache
+from .single_flight import SingleFlight
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None # artwork is sent without downscaling
 
 # Globals
-IMG_ROOT = Path('artwork/')
 EP_ROOT = Path('episodes/')
+EPISODE_CACHE_QUOTA = 2 * 1024 * 1024 * 1024 # bytes, leaves room on a small ephemeral disk
+EPISODE_CACHE_MAX_AGE = 24 * 60 * 60 # seconds, older partial downloads aren't resumed
+EPISODE_CACHE = DiskCache(EP_ROOT, EPISODE_CACHE_QUOTA, EPISODE_CACHE_MAX_AGE)
+ARTWORK_MAX_SIZE = 1280 # pixels, Telegram downscales larger photos anyway
+ARTWORK_QUALITY = 85
 MAX_SEARCH_RESULTS = 6
+MAX_LOCAL_SEARCH_RESULTS = 3 # leaves room for iTunes results in the merged list
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 30 * 60 # seconds
+SEARCH_CACHE = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+EP_DOWNLOADS = SingleFlight()
+
+# Analytics services that wrap enclosure URLs as <prefix>/<host>/<path>
+TRACKING_PREFIXES = re.compile(
+    r'^(?:www\.)?(?:'
+    r'dts\.podtrac\.com/redirect\.[a-z0-9]+'
+    r'|podtrac\.com/pts/redirect\.[a-z0-9]+'
+    r'|chtbl\.com/track/[^/]+'
+    r'|chrt\.fm/track/[^/]+'
+    r'|pdst\.fm/e'
+    r'|op3\.dev/e(?:,[^/]*)?'
+    r'|mgln\.ai/e/[^/]+'
+    r'|verifi\.podscribe\.com/rss/p'
+    r'|pfx\.vpixl\.com/[^/]+'
+    r'|claritaspod\.com/measure'
+    r'|arttrk\.com/p/[^/]+'
+    r')/', re.IGNORECASE)
+TRACKING_PARAMS = re.compile(r'^utm_[a-z]+$', re.IGNORECASE)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
 
 
 def get_search_json(search_term: str):
@@ -32,22 +65,52 @@ def get_search_json(search_term: str):
     Returns an iTunes json containing search results.
 
     json = {resultCount: int, results: [podcasts]}
-    """
-    max_results = str(MAX_SEARCH_RESULTS)
-    itunes_url = "https://itunes.apple.com/search?&media=podcast&limit="+max_results+"&term="
-    search_url = itunes_url + search_term
-    json_result = requests.get(search_url).json()
+
+    Results are cached by normalised search term, so repeated queries don't reach iTunes
+    until the cached entry expires. Error responses raise requests.HTTPError, and responses
+    without results aren't cached.
+    """
+    term = normalise_search_term(search_term)
+    json_result = SEARCH_CACHE.get(term)
+    if json_result is None:
+        max_results = str(MAX_SEARCH_RESULTS)
+        itunes_url = "https://itunes.apple.com/search?&media=podcast&limit="+max_results+"&term="
+        search_url = itunes_url + quote_plus(term)
+        response = http_client.get(search_url)
+        response.raise_for_status()
+        json_result = response.json()
+        if 'results' in json_result:
+            SEARCH_CACHE.set(term, json_result)
     
     return json_result
 
 
+def normalise_search_term(search_term: str):
+    """
+    Folds case and whitespace, so that 'The  Daily' and 'the+daily' share a cache entry.
+    """
+    return ' '.join(search_term.replace('+', ' ').split()).lower()
+
+
+def fts_query(search_term: str):
+    """
+    Turns free text into an FTS5 query matching every word, the last one as a prefix so that
+    partially typed words match too. Words are quoted, so FTS5 operators in the text are
+    searched for literally. Returns None if there are no words to search for.
+    """
+    words = re.findall(r'\w+', search_term.replace('+', ' '))
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
 def json_to_pods(results: list):
     """
     Converts a list of dicts into a list of Pod objects.
     """
     pods = []
     for entry in results:
-        pod = Pod(entry)
+        pod = entities.Pod(entry)
         if pod.valid:
             pods.append(pod)
 
@@ -75,30 +138,61 @@ def prettify_latest_release_date(date_str):
     return txt
 
 
-def download_artwork(img_url, pod_id):
+def fetch_artwork(img_url):
     """
-    Downloads the artwork for specified podcast and returns its path.
+    Downloads artwork into memory and returns it as a file object that can be passed to send_photo.
 
-    The artwork file is then deleted by parent process to save space, while its fileID is stored.
+    With Pillow installed, artwork larger than ARTWORK_MAX_SIZE on either side is downscaled, which
+    shrinks the upload without losing detail Telegram would keep. Without it, the artwork is sent as is.
     """
-    ext = str(pod_id) + '.jpg'
-    root = IMG_ROOT
-    
-    if not root.exists():
-        os.makedirs(IMG_ROOT)
-    if not (root/ext).exists():
-        img_data = requests.get(img_url)
-        with open(root/ext, 'wb') as im_file:
-            im_file.write(img_data.content)
-    
-    return root/ext
+    response = http_client.get(img_url)
+    response.raise_for_status()
+    data = response.content
 
+    if Image is not None:
+        try:
+            image = Image.open(BytesIO(data))
+            if max(image.size) > ARTWORK_MAX_SIZE:
+                image.thumbnail((ARTWORK_MAX_SIZE, ARTWORK_MAX_SIZE))
+                downscaled = BytesIO()
+                image.convert("RGB").save(downscaled, "JPEG", quality=ARTWORK_QUALITY)
+                data = downscaled.getvalue()
+        except (OSError, Image.DecompressionBombError):
+            pass # not an image Pillow can read, let Telegram decide
 
-def parse_feed(feed_url):
+    artwork = BytesIO(data)
+    artwork.name = "artwork.jpg"
+    return artwork
+
+
+def get_cached_artwork_id(img_url):
+    """
+    Returns the photo file ID of artwork already sent from img_url, for any podcast, or None.
+    """
+    return db.get_cached_file_id(PHOTO, img_url) if img_url else None
+
+
+def parse_feed(feed_url, only_if_modified=False):
     """
     Parses RSS feed. Returns a tuple of podcast information as a dict and a list of episode dicts.
+
+    The feed is fetched through feed_cache, so an unchanged feed isn't downloaded again.
+    With only_if_modified set, an unchanged feed isn't parsed either and None is returned.
     """
-    feed_root = feedparser.parse(feed_url)
+    return parse_fetched_feed(feed_cache.fetch(feed_url), only_if_modified)
+
+
+def parse_fetched_feed(feed, only_if_modified=False):
+    """
+    Parses a feed_cache.CachedFeed, like parse_feed.
+    """
+    if only_if_modified and not feed.modified:
+        return None
+
+    response_headers = {"content-location": feed.feed_url}
+    if feed.content_type:
+        response_headers["content-type"] = feed.content_type
+    feed_root = feedparser.parse(feed.body, response_headers=response_headers)
 
     return feed_root['feed'], feed_root['entries']
 
@@ -181,111 +275,106 @@ def process_ep_date(date_str):
     """
     Parses episode's release date. There are two most commong date formats in RSS feeds
     that this accounts for.
+
+    strptime leaves dates with a zone name naive, so GMT and UTC dates are made aware here,
+    or their timestamps would be taken as the host's local time.
     """
     try:
         res = datetime.strptime(date_str,"%a, %d %b %Y %H:%M:%S %z")
     except ValueError:
         res = datetime.strptime(date_str,"%a, %d %b %Y %H:%M:%S %Z")
+        if date_str.rstrip().upper().endswith(("GMT", "UTC")):
+            res = res.replace(tzinfo=timezone.utc)
         
     return res
 
 
-def create_paginated_list(res_per_page, n_items):
+def download_ep(link, ep_id, title, pod_title, thumb_id, on_progress=None, disk_limit=None):
     """
-    Creates a list of pages that contain indices of items to list.
-    """
-    n_chunks = n_items // res_per_page
-    res_list = [res_per_page * i for i in range(1, n_chunks + 1)]
-    remainder = n_items - res_per_page * n_chunks
-    
-    if remainder != 0:
-        res_list.append(n_items)
-        
-    return res_list
+    Downloads the audio file, then hands it to start_file_uploader.php through upload_jobs
+    and waits for its Telegram fileID. The fileID is returned.
 
+    The file is downloaded in parallel segments where the server allows it, see range_downloader.
+    on_progress(done, total) is called as bytes arrive. With a disk_limit, the download is refused
+    unless all episode files, this one included, fit in that many bytes of EPISODE_CACHE's quota.
 
-def download_ep(link, ep_id, title, pod_title, thumb_id):
-    """
-    Downloads the audio file, then waits for start_file_uploader.php to upload the file
-    and provide its Telegram fileID. The fileID is returned.
+    Concurrent requests for the same episode, or for the same source link, share a single
+    download and upload. Only the first request's on_progress is called.
     """ 
-    root = EP_ROOT
-    to_php = Path("episode_uploader/episodes_to_send/")
-    ep_id = str(ep_id)
-    ext = ep_id + '.mp3'
-    ext_txt = ep_id + '.txt'
-    ext_data = ep_id + '_data.txt'
-
-    if not root.exists():
-        os.makedirs(root)
-    if not to_php.exists():
-        os.makedirs(to_php)
-
-    with open(to_php/ext_data, "w") as f:
-        data = f"{title}::{pod_title}::{thumb_id}"
-        f.write(data)
-
-    if not root.exists():
-        os.makedirs(root)
-
-    # Download episode.mp3 if episode.txt isn't already there
-    if not (to_php/ext_txt).exists():
-        with urllib.request.urlopen(link) as response, open(root/ext, 'wb') as f:
-                shutil.copyfileobj(response, f)
-        os.rename(root/ext, to_php/ext)
-
-        # Start looking for episode.txt
-        found_response = False
-        while not found_response:
-            if (to_php/ext_txt).exists():
-                found_response = True
-                with open(to_php/ext_txt, "r") as f:
-                    ep_file_id = f.readline()
-                os.remove(to_php/ext_txt)
-            time.sleep(0.2)
-            
-    else:
-        with open(to_php/ext_txt, "r") as f:
-            ep_file_id = f.readline().rstrip()
-        os.remove(to_php/ext_txt)
+    keys = [("ep_id", str(ep_id)), ("link", normalise_enclosure_url(link)) if link else None]
+    return EP_DOWNLOADS.do(keys, _download_and_upload_ep, link, ep_id, title, pod_title, thumb_id, on_progress, disk_limit)
 
-    return ep_file_id
+
+def get_cached_file_id(link):
+    """
+    Returns the fileID of an audio file that was already uploaded from the same source,
+    regardless of the episode or podcast it was uploaded for.
+    """
+    if not link:
+        return None
+    return db.get_cached_file_id(AUDIO, normalise_enclosure_url(link))
 
 
-def truncate(s):
+def normalise_enclosure_url(url):
     """
-    This is called when preparing an episode for display.
-    Since podcast and episode descriptions are sent as captions to the artwork,
-    their length is limited to 1000 chars.
+    Reduces an enclosure URL to a key that is shared by all URLs serving the same file:
+    the fragment and default ports are dropped, the scheme and host are lowercased, analytics
+    redirect prefixes are unwrapped and utm_* query parameters are removed. Other query
+    parameters are kept, as some hosts use them to pick the file.
 
-    This ensures that the provided string is shorter than 1000 chars by appropriately
-    truncating everything past that threshold.
+    URLs that can't be parsed, e.g. because of a malformed port, are used as they are.
     """
-    if len(s) < 1000:
-        return s
-    res = ''
-    s_s = s.split('\n')
-    i = 0
-    while (len(res) < 1000) and (len(s_s[i]) < (1000 - len(res))):
-        res += s_s[i] + '\n'
-        i += 1
-    res = res[:-1] + '…'
-    
-    return res
+    url = url.strip()
+    try:
+        scheme = (urlsplit(url).scheme if '://' in url else '').lower() or 'http'
+        while True:
+            parts = urlsplit(url if '://' in url else '//' + url)
+            host_and_path = (parts.hostname or '') + parts.path
+            unwrapped = TRACKING_PREFIXES.sub('', host_and_path, count=1)
+            if unwrapped == host_and_path:
+                break
+            url = unwrapped + ('?' + parts.query if parts.query else '')
+
+        host = (parts.hostname or '').lower()
+        if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+            host += f":{parts.port}"
+    except ValueError:
+        return url
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                             if not TRACKING_PARAMS.match(k)))
+
+    return scheme + '://' + host + parts.path + ('?' + query if query else '')
+
+
+def episode_file_path(ep_id):
+    return EP_ROOT / (str(ep_id) + '.mp3')
+
+
+def _download_and_upload_ep(link, ep_id, title, pod_title, thumb_id, on_progress, disk_limit):
+    """
+    The downloaded file is only removed once it's uploaded. If the download or the upload fails,
+    the file is kept, so that the next attempt resumes the download or only repeats the upload,
+    until EPISODE_CACHE evicts it to make room for other downloads.
+    Raises disk_cache.CacheFull if the episodes being downloaded leave no room for this one.
+    """
+    path = episode_file_path(ep_id)
+
+    with EPISODE_CACHE.use(ep_id):
+        range_downloader.download(link, path, on_progress,
+                                  reserve=lambda n_bytes: EPISODE_CACHE.reserve(ep_id, n_bytes, disk_limit))
+        ep_file_id = upload_jobs.request_file_id(ep_id, path, title, pod_title, thumb_id)
+        db.cache_file_id(AUDIO, normalise_enclosure_url(link), ep_file_id, os.path.getsize(path))
+        range_downloader.remove_download(path)
+
+    return ep_file_id
 
 
 def clean_html(text):
     """
     Telegram only accepts text emphasis and link tags, so this strips the provided text
-    of everything else, appropriately replacing some tags with others.
+    of everything else, appropriately replacing some tags with others. See html_sanitizer.
     """
-    text_clean = re.sub(r'</?(p|ul|br)>|</li>', '', text)
-    text_clean = re.sub(r'<(h1|h2|h3)[^>]*>', '<b>', text_clean)
-    text_clean = re.sub(r'</(h1|h2|h3)>', '</b>', text_clean)
-    text_clean = re.sub(r'<li>', '- ', text_clean)
-    text_clean = re.sub(r'&nbsp;', ' ', text_clean)
-    
-    return text_clean
+    return html_sanitizer.sanitize(text)
 
 
 def convert_db_output_to_object(db_output, object_class):
@@ -293,12 +382,7 @@ def convert_db_output_to_object(db_output, object_class):
     A fetched row is a tuple of column values. This function converts it to a corresponding
     object
     """
-    keys = POD_COLUMNS if object_class == "Pod" else EP_COLUMNS
-    object_info = dict()
-    for i, key in enumerate(keys):
-        object_info[key] = db_output[i]
-
-    return Pod(object_info, new=False) if object_class == "Pod" else Episode(object_info, new=False)
+    return entities.Pod.from_row(db_output) if object_class == "Pod" else entities.Episode.from_row(db_output)
 
 
 def convert_object_to_db_input(object):
@@ -306,7 +390,7 @@ def convert_object_to_db_input(object):
     The database expects a tuple of values corresponding to columns.
     This function generates such tuple using the object's attributes based on the object's type.
     """
-    columns = POD_COLUMNS if isinstance(object, Pod) else EP_COLUMNS
+    columns = POD_COLUMNS if isinstance(object, entities.Pod) else EP_COLUMNS
     db_input = []
     for col in columns:
         db_input.append(getattr(object, col))
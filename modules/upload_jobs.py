@@ -0,0 +1,119 @@
+"""
+upload_jobs.py
+
+The job channel between the bot and episode_uploader/start_file_uploader.php.
+
+Each upload is recorded as a row in the upload_jobs table and sent to the uploader over a Unix socket
+as one JSON line. The uploader acknowledges the job when it starts uploading and replies with the
+file ID or an error on the same connection, so the waiting thread wakes up as soon as the result is
+ready instead of polling the filesystem.
+
+    bot -> uploader: {"job_id": 1, "path": "/abs/path/1234.mp3", "title": ..., "performer": ..., "thumb_id": ...}
+    uploader -> bot: {"job_id": 1, "status": "uploading"}
+    uploader -> bot: {"job_id": 1, "status": "done", "file_id": ...} or {"job_id": 1, "status": "failed", "error": ...}
+"""
+
+import json
+import socket
+import time
+from pathlib import Path
+
+# Local modules
+from .database import db
+
+UPLOADER_SOCKET = Path("episode_uploader/uploader.sock")
+CONNECT_TIMEOUT = 30 # seconds to wait for the uploader to come up
+UPLOAD_TIMEOUT = 30 * 60 # seconds, includes time spent queued behind other uploads
+
+QUEUED = "queued"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+
+
+class UploadError(Exception):
+    """
+    Raised when the uploader reports a failed job, or can't be reached.
+    """
+    def __init__(self, job_id, message):
+        super().__init__(f"upload job {job_id} failed: {message}")
+        self.job_id = job_id
+
+
+def request_file_id(ep_id, path, title, performer, thumb_id):
+    """
+    Submits an audio file to the uploader and blocks until its Telegram file ID is available.
+    Returns the file ID, or raises UploadError.
+    """
+    job_id = db.add_upload_job(ep_id, path, QUEUED, int(time.time()))
+    job = {
+        "job_id": job_id,
+        "path": str(Path(path).resolve()),
+        "title": title,
+        "performer": performer,
+        "thumb_id": thumb_id
+    }
+
+    try:
+        with _connect(job_id) as conn:
+            conn.settimeout(UPLOAD_TIMEOUT)
+            conn.sendall(json.dumps(job).encode("UTF-8") + b"\n")
+            replies = conn.makefile("r", encoding="UTF-8")
+            reply = _read_reply(job_id, replies)
+            if reply["status"] == UPLOADING:
+                _set_status(job_id, UPLOADING)
+                reply = _read_reply(job_id, replies)
+    except (OSError, ValueError) as e:
+        _set_status(job_id, FAILED, error=str(e))
+        raise UploadError(job_id, str(e)) from e
+
+    if reply["status"] != DONE or not reply.get("file_id"):
+        error = reply.get("error", "no file ID returned")
+        _set_status(job_id, FAILED, error=error)
+        raise UploadError(job_id, error)
+
+    _set_status(job_id, DONE, file_id=reply["file_id"])
+    return reply["file_id"]
+
+
+def _connect(job_id):
+    """
+    Connects to the uploader's socket, retrying while the uploader is starting up.
+    If it doesn't come up, the job is marked as failed.
+    """
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    delay = 0.1
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(str(UPLOADER_SOCKET))
+            return conn
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+            if time.monotonic() + delay > deadline:
+                _set_status(job_id, FAILED, error="uploader is not running")
+                raise UploadError(job_id, "uploader is not running")
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+
+def _read_reply(job_id, replies):
+    line = replies.readline()
+    if not line:
+        raise ConnectionError("uploader closed the connection")
+    reply = json.loads(line)
+    if reply.get("job_id") != job_id:
+        raise ValueError(f"reply for job {reply.get('job_id')}")
+    return reply
+
+
+def _set_status(job_id, status, file_id=None, error=None):
+    columns_to_update = {
+        "status": status,
+        "updated_at": int(time.time())
+    }
+    if file_id is not None:
+        columns_to_update["file_id"] = file_id
+    if error is not None:
+        columns_to_update["error"] = error
+    db.update_item_in_table(job_id, "upload_jobs", columns_to_update)
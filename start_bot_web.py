@@ -4,22 +4,28 @@ start_bot_web.py
 Starts the bot process hosted on a remote server, after initialising and registering handlers.
 """
 
-from telegram.ext import Updater, PicklePersistence
+from telegram.ext import Updater
 import logging
 import os
 
 # Local imports
 from modules.handlers import handlers
+from modules.persistence import SQLitePersistence
 from modules.generic_logic import error as error_handler
+from modules.subscription_poller import poller
+from modules.prefetcher import prefetcher
+from modules.notifications import Notifier
+from modules import episode_jobs, episode_sync
 
 # Globals
 BOT_TOKEN = "your_bot_token"
 HEROKU_APP = "your_heroku_app_handle"
 
 
-def initialise(bot_token, persistence_pickle):
-    persistence = PicklePersistence(filename=persistence_pickle)
+def initialise(bot_token, persistence_db):
+    persistence = SQLitePersistence(filename=persistence_db)
     up = Updater(token=bot_token, persistence=persistence, use_context=True)
+    persistence.schedule_eviction(up.job_queue)
     dp = up.dispatcher
 
     return up, dp
@@ -34,8 +40,19 @@ def add_handlers_to_dp(dp, handlers, error_handler):
 
 def start():
     port = os.environ.get('PORT')
-    up, dp = initialise(BOT_TOKEN, "undercast.pickle")
+    up, dp = initialise(BOT_TOKEN, "bot.db")
     add_handlers_to_dp(dp, handlers, error_handler)
+    notifier = Notifier(up.bot)
+    notifier.start()
+    prefetcher.start()
+
+    def on_new_episodes(pod, episodes):
+        notifier.notify_new_episodes(pod, episodes)
+        prefetcher.wake()
+
+    episode_sync.on_new_episodes = on_new_episodes
+    poller.start()
+    episode_jobs.resume_pending(up.bot)
 
     up.start_webhook(listen="0.0.0.0", port=int(port), url_path=BOT_TOKEN)
     up.bot.setWebhook(f"https://{HEROKU_APP}.herokuapp.com/{BOT_TOKEN}")
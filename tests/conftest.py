@@ -0,0 +1,18 @@
+"""
+conftest.py
+
+Setup shared by the test modules. The repository root is put on sys.path, and the working directory
+is moved to a temporary one before anything imports the database module, which opens bot.db in
+the working directory. Every thread's connection opens it there, so the directory mustn't change
+afterwards.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
@@ -0,0 +1,35 @@
+"""
+fake_bot.py
+
+Stands in for telegram.Bot in tests of code that sends messages, without talking to Telegram.
+"""
+
+import time
+from threading import Lock
+
+from telegram.error import RetryAfter
+
+
+class FakeBot:
+    """
+    Records sent messages with the time they were sent, read from 'clock'. Raises RetryAfter for
+    the first 'flood_after_calls' calls, if given, and the exceptions in 'errors' for the calls after that.
+    """
+    def __init__(self, flood_after_calls=0, retry_after=1, errors=(), clock=time.monotonic):
+        self.sent = []
+        self.clock = clock
+        self.calls = 0
+        self.flood_after_calls = flood_after_calls
+        self.retry_after = retry_after
+        self.errors = list(errors)
+        self.lock = Lock()
+
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.calls += 1
+            if self.calls <= self.flood_after_calls:
+                raise RetryAfter(self.retry_after)
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append((self.clock(), chat_id, text))
@@ -0,0 +1,78 @@
+"""
+test_database.py
+
+Tests that DB.transaction blocks on different threads don't share their nesting or their writes.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import unittest
+from threading import Event, Thread
+
+from modules.database import db
+
+TIMEOUT = 5 # seconds
+
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        db.cursor.execute("DELETE FROM users")
+        db.connection.commit()
+
+
+    def count_users(self):
+        return db.cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+    def test_depth_is_per_thread(self):
+        inside, checked = Event(), Event()
+        seen = {}
+
+        def other_thread():
+            inside.wait(TIMEOUT)
+            seen["depth"] = db.transaction_depth
+            db.commit() # outside a transaction on this thread, must not commit the other thread's
+            seen["users"] = self.count_users()
+            checked.set()
+
+        thread = Thread(target=other_thread)
+        thread.start()
+        with self.assertRaises(RuntimeError):
+            with db.transaction():
+                db.cursor.execute("INSERT INTO users VALUES (1)")
+                self.assertEqual(db.transaction_depth, 1)
+                inside.set()
+                checked.wait(TIMEOUT)
+                raise RuntimeError("roll back")
+        thread.join(TIMEOUT)
+
+        self.assertEqual(seen, {"depth": 0, "users": 0})
+        self.assertEqual(db.transaction_depth, 0)
+        self.assertEqual(self.count_users(), 0)
+
+
+    def test_concurrent_transactions_commit_separately(self):
+        errors = []
+
+        def insert(user_id):
+            try:
+                with db.transaction():
+                    with db.transaction():
+                        db.cursor.execute("INSERT INTO users VALUES (?)", (user_id,))
+                    if user_id % 2:
+                        raise RuntimeError("roll back")
+            except RuntimeError:
+                pass
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=insert, args=(user_id,)) for user_id in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(TIMEOUT)
+
+        self.assertEqual(errors, [])
+        users = [row[0] for row in db.cursor.execute("SELECT user_id FROM users ORDER BY user_id")]
+        self.assertEqual(users, [0, 2, 4, 6])
@@ -0,0 +1,42 @@
+"""
+test_entities.py
+
+Tests that episodes get the same published_ts for a date however the feed writes its zone,
+on a host that isn't in UTC.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import os
+import time
+import unittest
+from unittest import mock
+
+from modules.entities import Episode
+
+PUBLISHED_TS = 1578132000 # 04 January 2020 10:00 UTC
+
+
+def make_entry(published):
+    return {"title": "Episode", "summary": "", "published": published,
+            "links": [{"href": "https://cdn.example/1.mp3"}]}
+
+
+class TestPublishedDate(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.dict(os.environ, {"TZ": "America/New_York"})
+        patch.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(patch.stop)
+        time.tzset()
+
+
+    def test_zone_names_and_offsets_agree(self):
+        for published in ("Sat, 04 Jan 2020 10:00:00 GMT",
+                          "Sat, 04 Jan 2020 10:00:00 UTC",
+                          "Sat, 04 Jan 2020 10:00:00 +0000",
+                          "Sat, 04 Jan 2020 05:00:00 -0500"):
+            ep = Episode(make_entry(published), "1", 0)
+            self.assertEqual(ep.published_ts, PUBLISHED_TS, published)
+            self.assertEqual(ep.published_str, "04 January 2020")
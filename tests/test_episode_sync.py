@@ -0,0 +1,139 @@
+"""
+test_episode_sync.py
+
+Tests that episode_sync stores each new feed entry once, including when two syncs of the same
+podcast overlap, and that a failed sync doesn't keep the feed's new validators.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import unittest
+from threading import Barrier, Thread
+from types import SimpleNamespace
+from unittest import mock
+
+from modules import episode_sync, http_client
+from modules.database import db, POD_COLUMNS
+
+POD_ID = "4242"
+FEED_URL = "https://example.com/feed"
+TIMEOUT = 5 # seconds
+
+
+def make_item(index, guid=True, link=True):
+    return (f"<item><title>Episode {index}</title><description>notes</description>"
+            f"<pubDate>Sat, {index + 1:02} Feb 2020 10:00:00 +0000</pubDate>"
+            + (f"<guid>guid-{index}</guid>" if guid else "")
+            + (f'<enclosure url="https://cdn.example/{index}.mp3" type="audio/mpeg" length="1"/>' if link
+               else f"<link>https://example.com/{index}</link>")
+            + "</item>")
+
+
+class FakeFeedHost:
+    """
+    Serves an RSS feed of 'items' with an ETag, answering requests that send it back with a 304.
+    """
+    def __init__(self, items, etag='"a"'):
+        self.items = items
+        self.etag = etag
+        self.requests = []
+
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or dict()
+        self.requests.append(headers)
+        if headers.get("If-None-Match") == self.etag:
+            return SimpleNamespace(status_code=304, content=b"", headers=dict(), raise_for_status=lambda: None)
+        body = f'<?xml version="1.0"?><rss version="2.0"><channel><title>Podcast</title>{"".join(self.items)}</channel></rss>'
+        return SimpleNamespace(status_code=200, content=body.encode(), raise_for_status=lambda: None,
+                               headers={"ETag": self.etag, "Content-Type": "application/rss+xml"})
+
+
+class TestSyncPodcast(unittest.TestCase):
+    def setUp(self):
+        with db.transaction():
+            db.cursor.execute("DELETE FROM episodes WHERE pod_id = ?", (int(POD_ID),))
+            db.cursor.execute("DELETE FROM podcasts WHERE pod_id = ?", (int(POD_ID),))
+            db.cursor.execute("DELETE FROM feeds WHERE feed_url = ?", (FEED_URL,))
+            db.add_podcast(tuple(POD_ID if column == "pod_id" else None for column in POD_COLUMNS))
+
+
+    def serve(self, host):
+        patch = mock.patch.object(http_client, "get", host.get)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
+    def make_pod(self):
+        return SimpleNamespace(pod_id=POD_ID, feed_url=FEED_URL, last_synced=None)
+
+
+    def stored_titles(self):
+        return sorted(row[2] for row in db.get_all_episodes(POD_ID))
+
+
+    def test_overlapping_syncs(self):
+        host = FakeFeedHost([make_item(index) for index in range(3)])
+        both_fetching = Barrier(2)
+        def get(url, **kwargs):
+            both_fetching.wait(TIMEOUT)
+            return FakeFeedHost.get(host, url, **kwargs)
+        host.get = get
+        self.serve(host)
+        errors = []
+
+        def sync():
+            try:
+                # bypasses the single-flight, so the two syncs of the podcast really overlap
+                episode_sync._sync_podcast(self.make_pod())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=sync) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(TIMEOUT)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.stored_titles(), ["Episode 0", "Episode 1", "Episode 2"])
+
+
+    def test_entries_without_identity(self):
+        self.serve(FakeFeedHost([make_item(index, guid=False, link=False) for index in range(2)]))
+        _, new_episodes = episode_sync.sync_podcast(self.make_pod())
+
+        self.assertEqual(len(new_episodes), 2)
+        self.assertEqual(self.stored_titles(), ["Episode 0", "Episode 1"])
+
+
+    def test_failed_sync_refetches_feed(self):
+        host = FakeFeedHost([make_item(0)])
+        self.serve(host)
+        episode_sync.sync_podcast(self.make_pod())
+
+        host.items.append(make_item(1))
+        host.etag = '"b"'
+        with mock.patch.object(db, "add_episodes", side_effect=RuntimeError("disk I/O error")):
+            with self.assertRaises(RuntimeError):
+                episode_sync.sync_podcast(self.make_pod())
+        _, new_episodes = episode_sync.sync_podcast(self.make_pod())
+
+        self.assertEqual(host.requests[-1].get("If-None-Match"), '"a"')
+        self.assertEqual([ep.title for ep in new_episodes], ["Episode 1"])
+        self.assertEqual(self.stored_titles(), ["Episode 0", "Episode 1"])
+
+
+    def test_new_episodes_are_reported(self):
+        host = FakeFeedHost([make_item(0)])
+        self.serve(host)
+        reported = []
+        with mock.patch.object(episode_sync, "on_new_episodes", lambda pod, eps: reported.append(eps)):
+            pod = self.make_pod()
+            episode_sync.sync_podcast(pod) # the first sync only records the back catalogue
+            host.items.append(make_item(1))
+            host.etag = '"b"'
+            episode_sync.sync_podcast(pod)
+
+        self.assertEqual([[ep.title for ep in eps] for eps in reported], [["Episode 1"]])
@@ -0,0 +1,86 @@
+"""
+test_html_sanitizer.py
+
+Tests that sanitize repairs bad HTML, that its output is stable when sanitized again, and that
+captions cut short stay well-formed.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import random
+import unittest
+
+from modules import captions
+from modules.html_sanitizer import sanitize
+
+FRAGMENTS = [
+        "<b>", "</b>", "<strong>", "</strong >", "<i>", "</em>", "<em class='x'>", "<u>", "</u>", "<s>", "</del>",
+        "<code>", "</code>", "<pre>", "</pre>", "<h2>", "</h2>", "<h1 id=x>", "</h3>", "<p>", "</p>", "<p class=\"x\">",
+        "<br>", "<br/>", "<li>", "</li>", "<ul>", "</ul>", "<span>", "</span>", "<img src=x />", "<b/>", "<p_x>",
+        "<a href=\"https://x.y/a?b=1&amp;c=2\">", "<a target=\"_blank\" href=\"http://q\">", "<a href='https://s'>",
+        "<a data-href=\"javascript:1\" href=\"https://z\">", "<a href=\"javascript:x\">", "<A HREF=\"https://u\">",
+        "<a href=\" https://sp \">", "<a href=\"mailto:m@x\">", "</a>", "<script>", "</script>", "<!-- c -->", "<!--",
+        "a < b", "x > y", "&amp;", "&lt;", "&nbsp;", "&#39;", "&copy", "AT & T", "\xa0",
+        " ", "\n", "\t", " \n ", "\n\n", "text"
+    ]
+
+
+class TestSanitize(unittest.TestCase):
+    def test_output_is_stable(self):
+        rnd = random.Random(0)
+        for _ in range(5000):
+            text = "".join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(1, 12)))
+            sanitized = sanitize(text)
+            self.assertEqual(sanitize(sanitized), sanitized, repr(text))
+
+
+    def test_regular_notes(self):
+        text = ('<p>With <strong>Guest</strong> &amp; friends&nbsp;today.</p>\n<h2>Links</h2>'
+                '<ul><li><a href="https://example.com/?a=1&amp;b=2" target="_blank">Site</a></li></ul>')
+        self.assertEqual(sanitize(text), 'With <b>Guest</b> &amp; friends today.\n\n<b>Links</b>\n\n'
+                                         '- <a href="https://example.com/?a=1&amp;b=2">Site</a>')
+
+
+    def test_repairs_nesting(self):
+        self.assertEqual(sanitize("<b><i>x</b>y</i>"), "<b><i>x</i></b>y")
+        self.assertEqual(sanitize("<a href=\"https://a\">x<a href=\"https://b\">y</a>z</a>"),
+                         '<a href="https://a">xy</a>z')
+        self.assertEqual(sanitize("<b>open"), "<b>open</b>")
+
+
+    def test_nested_links(self):
+        self.assertEqual(sanitize('<a href="https://a"><b>x</b><a href="https://b">y</a></a>'),
+                         '<a href="https://a"><b>x</b>y</a>')
+        self.assertEqual(sanitize('<a href="javascript:x">x<a href="https://b">y</a></a>'),
+                         'x<a href="https://b">y</a>')
+
+
+    def test_heading_inside_link(self):
+        self.assertEqual(sanitize('<a href="https://a">see <h2>Title</h2> here</a>'),
+                         '<a href="https://a">see\n\n<b>Title</b>\n\n here</a>')
+
+
+    def test_self_closing_tags(self):
+        self.assertEqual(sanitize("a<br/>b<b/>c<img src=x />d<p/>e"), "a\nbcd\n\ne")
+
+
+    def test_drops_unsupported_content(self):
+        self.assertEqual(sanitize('<script>alert(1)</script><a href="javascript:x">link</a><!-- c -->'), "link")
+        self.assertEqual(sanitize('a<style><b>x</style>b<script>c</style>d'), "ab")
+
+
+    def test_entities_next_to_tags(self):
+        self.assertEqual(sanitize("&amp<b>&lt;</b>&gt;<i>&#65;</i>&copy"), "&amp;<b>&lt;</b>&gt;<i>A</i>©")
+        self.assertEqual(sanitize("&amp<b>\0</b>&gt;"), "&amp;<b>\0</b>&gt;")
+
+
+class TestTruncate(unittest.TestCase):
+    def test_closes_tags_left_open(self):
+        line = "x" * 60 + "\n"
+        notes = sanitize("<b>Notes</b>\n<i>" + line * 30 + "</i><a href=\"https://a\">" + line * 30 + "</a>")
+        caption = captions.truncate(notes)
+
+        self.assertLess(len(caption), len(notes))
+        self.assertTrue(caption.endswith("…</i>"))
+        self.assertEqual(sanitize(caption), caption)
@@ -0,0 +1,182 @@
+"""
+test_notifications.py
+
+Tests of the notifier's rate limiting, RetryAfter handling and digests, against FakeBot.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from modules import notifications
+from modules.notifications import Notifier
+
+from fake_bot import FakeBot
+
+TIMEOUT = 5 # seconds
+STEP = 0.001 # seconds the fake clock moves on while the notifier has nothing to send
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class NotifierTestCase(unittest.TestCase):
+    """
+    Runs the sender loop's steps on the test's own thread against a fake clock, so rate limits and
+    pauses are checked without real sleeps.
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+
+
+    def make_notifier(self, bot, **kwargs):
+        return Notifier(bot, clock=self.clock, **kwargs)
+
+
+    def make_bot(self, **kwargs):
+        return FakeBot(clock=self.clock, **kwargs)
+
+
+    def send_until(self, notifier, condition, max_steps=100000):
+        for _ in range(max_steps):
+            if condition():
+                return
+            notifier.flush_digests()
+            message = notifier.next_message()
+            if message is None:
+                self.clock.now += STEP
+            else:
+                notifier.deliver(message)
+        raise AssertionError("notifier made no progress")
+
+
+class TestRateLimits(NotifierTestCase):
+    def test_global_rate_after_burst(self):
+        bot = self.make_bot()
+        notifier = self.make_notifier(bot, global_rate=50)
+        count = notifications.GLOBAL_BURST + 10
+        for chat_id in range(count):
+            notifier.send(chat_id, "hi")
+
+        self.send_until(notifier, lambda: len(bot.sent) == count)
+        times = [sent_at for sent_at, _, _ in bot.sent]
+        # the burst goes out at once, the other 10 messages at 50 per second
+        self.assertEqual(times[notifications.GLOBAL_BURST - 1], times[0])
+        self.assertAlmostEqual(times[-1] - times[0], 10 / 50, delta=2 * STEP)
+
+
+    def test_per_chat_rate(self):
+        bot = self.make_bot()
+        notifier = self.make_notifier(bot, per_chat_rate=10)
+        count = notifications.PER_CHAT_BURST + 3
+        for _ in range(count):
+            notifier.send(1, "hi")
+        notifier.send(2, "other chat")
+
+        self.send_until(notifier, lambda: len(bot.sent) == count + 1)
+        times = [sent_at for sent_at, chat_id, _ in bot.sent if chat_id == 1]
+        self.assertAlmostEqual(times[-1] - times[0], 3 / 10, delta=2 * STEP)
+        # the other chat isn't held up behind chat 1's limit
+        self.assertLess(next(index for index, sent in enumerate(bot.sent) if sent[1] == 2), count)
+
+
+    def test_priority_order(self):
+        bot = self.make_bot()
+        notifier = self.make_notifier(bot)
+        notifier.send(1, "low", priority=notifications.PRIORITY_LOW)
+        notifier.send(2, "high", priority=notifications.PRIORITY_HIGH)
+
+        self.send_until(notifier, lambda: len(bot.sent) == 2)
+        self.assertEqual([text for _, _, text in bot.sent], ["high", "low"])
+
+
+class TestRetries(NotifierTestCase):
+    def test_retry_after_pauses_sender(self):
+        bot = self.make_bot(flood_after_calls=1, retry_after=0.3)
+        notifier = self.make_notifier(bot)
+        started = self.clock()
+        notifier.send(1, "hi")
+        notifier.send(2, "hi")
+
+        self.send_until(notifier, lambda: len(bot.sent) == 2)
+        self.assertAlmostEqual(bot.sent[0][0] - started, 0.3, delta=2 * STEP)
+        self.assertGreaterEqual(bot.sent[0][0] - started, 0.3)
+        stats = notifier.stats()
+        self.assertEqual(stats["rate_limited"], 1)
+        self.assertEqual(stats["sent"], 2)
+
+
+    def test_dropped_messages(self):
+        from telegram.error import Unauthorized
+        bot = self.make_bot(errors=[Unauthorized("blocked")])
+        notifier = self.make_notifier(bot)
+        notifier.send(1, "blocked")
+        notifier.send(2, "hi")
+
+        self.send_until(notifier, lambda: len(bot.sent) == 1)
+        self.assertEqual(bot.sent[0][1], 2)
+        self.assertEqual(notifier.stats()["failed"], 1)
+
+
+    def test_sender_survives_unexpected_errors(self):
+        # runs the real sender thread, on the real clock, as only the loop in run catches these
+        bot = FakeBot(errors=[ValueError("bug")])
+        notifier = Notifier(bot)
+        notifier.start()
+        self.addCleanup(notifier.stop)
+        with mock.patch.object(notifications, "ERROR_BACKOFF", 0):
+            notifier.send(1, "lost")
+            notifier.send(2, "hi")
+            wait_for(lambda: len(bot.sent) == 1)
+        self.assertTrue(notifier.thread.is_alive())
+
+
+class TestDigests(NotifierTestCase):
+    def test_one_digest_per_user(self):
+        bot = self.make_bot()
+        notifier = self.make_notifier(bot, digest_window=0.1)
+        pods = [SimpleNamespace(pod_id=pod_id, title=f"Podcast {pod_id}") for pod_id in (1, 2)]
+        episodes = [SimpleNamespace(title="Episode <1>", duration="1h")]
+
+        started = self.clock()
+        with mock.patch.object(notifications.db, "get_subscribers", return_value=[10, 20]):
+            for pod in pods:
+                notifier.notify_new_episodes(pod, episodes)
+
+        self.send_until(notifier, lambda: len(bot.sent) == 2)
+        # the digests wait for the window to close, so later updates can join them
+        self.assertGreaterEqual(bot.sent[0][0] - started, 0.1)
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in bot.sent), [10, 20])
+        for _, _, text in bot.sent:
+            self.assertIn("Podcast 1", text)
+            self.assertIn("Podcast 2", text)
+            self.assertIn("Episode &lt;1&gt;", text)
+        self.assertEqual(notifier.stats()["digests"], 2)
+
+
+    def test_long_digests_are_split(self):
+        pod = SimpleNamespace(title="Podcast")
+        episodes = [SimpleNamespace(title="x" * 500, duration="1h")] * notifications.MAX_EPISODES_PER_PODCAST
+        texts = notifications.render_digest([(pod, episodes)] * 5)
+
+        self.assertGreater(len(texts), 1)
+        for text in texts:
+            self.assertLessEqual(len(text), notifications.MAX_MESSAGE_LENGTH)
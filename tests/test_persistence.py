@@ -0,0 +1,75 @@
+"""
+test_persistence.py
+
+Tests that SQLitePersistence drops idle chats and users from memory while the dispatcher saves
+all of them after every job, and keeps those that handlers use.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import os
+import tempfile
+import unittest
+from queue import Queue
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram.ext import Dispatcher
+
+from modules import persistence
+from modules.persistence import SQLitePersistence
+
+IDLE_TIMEOUT = 30 * 60 # seconds
+EVICTION_INTERVAL = 5 * 60 # seconds
+
+
+class TestEviction(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        clock = mock.patch.object(persistence, "time", SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+        directory = tempfile.mkdtemp()
+        self.persistence = SQLitePersistence(filename=os.path.join(directory, "persistence.db"),
+                                             idle_timeout=IDLE_TIMEOUT)
+        self.dispatcher = Dispatcher(mock.Mock(), Queue(), persistence=self.persistence, use_context=True)
+
+
+    def run_eviction_jobs(self, count, active_chat=None):
+        """
+        Runs the eviction job 'count' times, each followed by the dispatcher's update_persistence
+        as the JobQueue does. A handler reads active_chat's data between jobs.
+        """
+        for _ in range(count):
+            self.now += EVICTION_INTERVAL
+            if active_chat is not None:
+                self.dispatcher.chat_data[active_chat]
+            self.persistence.evict_idle()
+            self.dispatcher.update_persistence()
+
+
+    def test_idle_entries_are_evicted(self):
+        self.dispatcher.chat_data[1]["page"] = 2
+        self.dispatcher.user_data[10]["page"] = 3
+        self.dispatcher.update_persistence()
+
+        self.run_eviction_jobs(IDLE_TIMEOUT // EVICTION_INTERVAL + 1)
+
+        self.assertNotIn(1, self.dispatcher.chat_data)
+        self.assertNotIn(10, self.dispatcher.user_data)
+        # evicted data is reloaded from the database on its next use
+        self.assertEqual(self.dispatcher.chat_data[1], {"page": 2})
+        self.assertEqual(self.dispatcher.user_data[10], {"page": 3})
+
+
+    def test_active_entries_are_kept(self):
+        self.dispatcher.chat_data[1]["page"] = 2
+        self.dispatcher.chat_data[2]["page"] = 4
+        self.dispatcher.update_persistence()
+
+        self.run_eviction_jobs(4 * IDLE_TIMEOUT // EVICTION_INTERVAL, active_chat=2)
+
+        self.assertNotIn(1, self.dispatcher.chat_data)
+        self.assertIn(2, self.dispatcher.chat_data)
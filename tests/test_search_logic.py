@@ -0,0 +1,82 @@
+"""
+test_search_logic.py
+
+Tests that podcast search merges the local and iTunes results of the same podcast into one button,
+and that podcast artwork falls back to its URL, then to an upload, when Telegram can't use it.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram.error import BadRequest
+
+from modules import inline_keyboards, search_logic, tools
+from modules.database import db, PHOTO
+
+ITUNES_RESULT = {
+        "collectionId": 3131,
+        "collectionName": "The Podcast",
+        "artistName": "Someone",
+        "feedUrl": "https://example.com/feed",
+        "artworkUrl600": "https://example.com/art.jpg",
+        "releaseDate": "2020-01-04T10:00:00Z",
+        "trackCount": 10
+    }
+
+
+class PhotoBot:
+    """
+    Sends photos, except that it rejects the photos in 'rejected' with the given error message.
+    """
+    def __init__(self, rejected, error="Wrong file identifier/HTTP URL specified"):
+        self.rejected = rejected
+        self.error = error
+        self.photos = []
+
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.photos.append(photo)
+        if isinstance(photo, str) and photo in self.rejected:
+            raise BadRequest(self.error)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"sent-{len(self.photos)}", file_size=1)])
+
+
+class TestSearchResults(unittest.TestCase):
+    def test_podcast_found_locally_and_on_itunes(self):
+        itunes_pods = tools.json_to_pods([ITUNES_RESULT, dict(ITUNES_RESULT, collectionId=3132)])
+        db.upsert_podcasts([tools.convert_object_to_db_input(pod) for pod in itunes_pods[:1]])
+        local_pods = [tools.convert_db_output_to_object(db.get_podcast("3131"), "Pod")]
+
+        pods = search_logic.merge_search_results(local_pods, itunes_pods)
+
+        self.assertEqual([str(pod.pod_id) for pod in pods], ["3131", "3132"])
+        keyboard = inline_keyboards.pod_list_keyboard(pods).to_dict()["inline_keyboard"]
+        self.assertEqual([row[0]["callback_data"] for row in keyboard], ["3131", "3132"])
+
+
+class TestSendArtwork(unittest.TestCase):
+    def setUp(self):
+        self.pod = tools.json_to_pods([dict(ITUNES_RESULT, collectionId=3133)])[0]
+        self.pod.image_file_id = "stale-file-id"
+        db.upsert_podcasts([tools.convert_object_to_db_input(self.pod)])
+
+
+    def test_falls_back_to_url_then_upload(self):
+        bot = PhotoBot(rejected={"stale-file-id", self.pod.image_url})
+        with mock.patch.object(tools, "fetch_artwork", return_value=b"artwork"):
+            search_logic.send_artwork(bot, 1, self.pod, "caption", None)
+
+        self.assertEqual(bot.photos, ["stale-file-id", self.pod.image_url, b"artwork"])
+        self.assertEqual(self.pod.image_file_id, "sent-3")
+        self.assertEqual(db.get_cached_file_id(PHOTO, self.pod.image_url), "sent-3")
+
+
+    def test_other_errors_are_raised(self):
+        bot = PhotoBot(rejected={"stale-file-id"}, error="Message caption is too long")
+        with self.assertRaises(BadRequest):
+            search_logic.send_artwork(bot, 1, self.pod, "caption", None)
+        self.assertEqual(bot.photos, ["stale-file-id"])
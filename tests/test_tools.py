@@ -0,0 +1,34 @@
+"""
+test_tools.py
+
+Tests that enclosure URLs of the same file share a file ID cache key, and URLs of different files don't.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import unittest
+
+from modules.tools import normalise_enclosure_url
+
+
+class TestNormaliseEnclosureUrl(unittest.TestCase):
+    def test_same_file(self):
+        key = normalise_enclosure_url("https://example.com/a.mp3")
+        for url in ("https://dts.podtrac.com/redirect.mp3/example.com/a.mp3",
+                    "HTTPS://Example.com:443/a.mp3#t=10",
+                    "https://example.com/a.mp3?utm_source=rss&utm_medium=feed"):
+            self.assertEqual(normalise_enclosure_url(url), key, url)
+
+
+    def test_different_files(self):
+        urls = ["https://example.com/a.mp3",
+                "http://example.com/a.mp3",
+                "https://example.com/a.mp3?source=1",
+                "https://example.com/a.mp3?source=2",
+                "https://example.com:8443/a.mp3"]
+        self.assertEqual(len({normalise_enclosure_url(url) for url in urls}), len(urls))
+
+
+    def test_malformed_port(self):
+        self.assertEqual(normalise_enclosure_url(" https://example.com:abc/a.mp3 "), "https://example.com:abc/a.mp3")